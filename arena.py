@@ -0,0 +1,267 @@
+import argparse
+import ast
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import math
+import random
+import sys
+import time
+
+import game_record
+import minimax_vs_uttt
+import negamax
+from uttt_api import *
+
+class RandomAgent(object):
+    '''Plays a uniformly random legal move.'''
+
+    def __init__(self, **kwargs):
+        pass
+
+    def move(self, state):
+        return random.choice(state.legal_moves())
+
+    def update(self, state):
+        pass
+
+class MonteCarloAgent(object):
+    '''MonteCarlo player that keeps its tree for the whole game.
+
+    Takes the MonteCarlo keyword arguments (time, C, max_moves, ...).
+    '''
+    engine = MonteCarlo
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.player = None
+
+    def move(self, state):
+        if self.player is None:
+            self.player = self.engine(state, **self.kwargs)
+        return self.player.get_play()
+
+    def update(self, state):
+        if self.player is not None:
+            self.player.update(state)
+
+class PooledMonteCarloAgent(MonteCarloAgent):
+    '''PooledMonteCarlo player; also takes node_budget and evict_fraction.'''
+    engine = PooledMonteCarlo
+
+class MiniMaxAgent(object):
+    '''getMove player with its own transposition table.
+
+    Takes the getMove keyword arguments searchDepth and timeout.
+    '''
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.table = TranspositionTable()
+
+    def move(self, state):
+        return minimax_vs_uttt.getMove(state, table=self.table, **self.kwargs)
+
+    def update(self, state):
+        pass
+
+class NegamaxAgent(MiniMaxAgent):
+    '''negamaxMove player with its own transposition table.
+
+    Takes the negamaxMove keyword arguments searchDepth and timeout.
+    '''
+
+    def move(self, state):
+        return negamax.negamaxMove(state, table=self.table, **self.kwargs)
+
+AGENTS = {'random': RandomAgent, 'mcts': MonteCarloAgent, 'pooled': PooledMonteCarloAgent,
+          'minimax': MiniMaxAgent, 'negamax': NegamaxAgent}
+
+def parseAgent(text):
+    """
+    Parse an agent spec such as "mcts:time=0.1,C=1.4" or "minimax:searchDepth=3,timeout=1".
+
+    @return: A dictionary with the agent "type", its "name" (the spec itself unless
+             given as name=...) and the keyword arguments for the agent in "kwargs".
+    """
+    kind, _, options = text.partition(":")
+    if kind not in AGENTS:
+        raise ValueError("Unknown agent type " + kind + "; expected one of " + ", ".join(AGENTS))
+    kwargs = {}
+    for option in filter(None, options.split(",")):
+        key, value = option.split("=")
+        try:
+            kwargs[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            kwargs[key] = value
+    name = kwargs.pop("name", text)
+    return {"type": kind, "name": name, "kwargs": kwargs}
+
+def playGame(specs, seed):
+    """
+    Play one game between two agent specs; specs[0] plays 'O' and moves first.
+
+    @return: A dictionary with the seed, the agent names, the winner
+             (O:0, X:1 or DRAW:2), the number of moves, the cells played
+             (see game_record.cellOf) and each agent's per-move latencies
+             in seconds.
+    """
+    random.seed(seed)
+    agents = [AGENTS[spec["type"]](**spec["kwargs"]) for spec in specs]
+    latencies = [[], []]
+    state = BitboardUtttState()
+    cells = []
+    # the engines print their statistics
+    with contextlib.redirect_stdout(io.StringIO()):
+        while not state.is_terminal():
+            player = max(0, state.action[2] ^ 1)
+            begin = time.perf_counter()
+            action = agents[player].move(state)
+            latencies[player].append(time.perf_counter() - begin)
+            state = BitboardUtttState(parent=state, action=action)
+            state.parent = None
+            for agent in agents:
+                agent.update(state)
+            cells.append(game_record.cellOf(action))
+    return {"seed": seed, "O": specs[0]["name"], "X": specs[1]["name"],
+            "result": state.result(), "moves": len(cells), "cells": cells,
+            "latency_O": [round(t, 6) for t in latencies[O]],
+            "latency_X": [round(t, 6) for t in latencies[X]]}
+
+def schedule(specs, games, seed):
+    # every pair of agents plays `games` games, swapping colors every game
+    for a, b in itertools.combinations(range(len(specs)), 2):
+        for i in range(games):
+            pair = [specs[a], specs[b]] if i % 2 == 0 else [specs[b], specs[a]]
+            yield pair, seed + i
+
+def runTournament(specs, games, workers, seed, output, record = None):
+    """
+    Play all games of the tournament on a process pool and append every result
+    to output, one JSON line per game, and to record, a game_record.GameWriter,
+    as soon as it is known.
+
+    @return: The list of game results.
+    """
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(playGame, pair, gameSeed)
+                   for pair, gameSeed in schedule(specs, games, seed)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if output is not None:
+                output.write(json.dumps(result, separators=(",", ":")) + "\n")
+                output.flush()
+            if record is not None:
+                record.write([game_record.actionOf(cell, ply)
+                              for ply, cell in enumerate(result["cells"])], result["result"])
+    return results
+
+def elo(score):
+    # Elo difference that corresponds to an expected score
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+def pairStats(results, a, b):
+    """
+    Win/draw/loss of agent a against agent b, with the score, its 95% confidence
+    interval and the Elo difference over that interval.
+    """
+    win = draw = loss = 0
+    for result in results:
+        if {result["O"], result["X"]} != {a, b}:
+            continue
+        if result["result"] == DRAW:
+            draw += 1
+        elif result["OX"[result["result"]]] == a:
+            win += 1
+        else:
+            loss += 1
+    n = win + draw + loss
+    score = (win + draw / 2) / n
+    variance = (win * (1 - score) ** 2 + draw * (0.5 - score) ** 2 + loss * score ** 2) / n
+    margin = 1.96 * math.sqrt(variance / n)
+    return {"games": n, "win": win, "draw": draw, "loss": loss,
+            "score": score, "score_low": max(0.0, score - margin),
+            "score_high": min(1.0, score + margin),
+            "elo": elo(score), "elo_low": elo(score - margin), "elo_high": elo(score + margin)}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def latencyStats(results, name):
+    # per-move latency percentiles of one agent, in milliseconds
+    latencies = []
+    for result in results:
+        for color in "OX":
+            if result[color] == name:
+                latencies.extend(result["latency_" + color])
+    if not latencies:
+        return {}
+    return {"moves": len(latencies),
+            "p50": 1000 * percentile(latencies, 0.5),
+            "p90": 1000 * percentile(latencies, 0.9),
+            "p99": 1000 * percentile(latencies, 0.99),
+            "max": 1000 * max(latencies)}
+
+def report(specs, results):
+    names = [spec["name"] for spec in specs]
+    for a, b in itertools.combinations(names, 2):
+        stats = pairStats(results, a, b)
+        print("{} vs {}: +{win} ={draw} -{loss} of {games}, score {score:.3f} "
+              "[{score_low:.3f}, {score_high:.3f}], Elo {elo:+.0f} "
+              "[{elo_low:+.0f}, {elo_high:+.0f}]".format(a, b, **stats))
+    for name in names:
+        stats = latencyStats(results, name)
+        if stats:
+            print("{}: {moves} moves, latency p50 {p50:.1f} ms, p90 {p90:.1f} ms, "
+                  "p99 {p99:.1f} ms, max {max:.1f} ms".format(name, **stats))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Play seeded games between UTTT agents on a process pool.")
+    parser.add_argument("agents", nargs="+",
+                        help="agent specs, e.g. random, mcts:time=0.1,C=1.4, "
+                             "minimax:searchDepth=3,timeout=1, negamax:searchDepth=3; add name=... to rename")
+    parser.add_argument("--games", type=int, default=100,
+                        help="games per pair of agents, colors alternating (default: 100)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game (default: 0)")
+    parser.add_argument("--output", default=None,
+                        help="append one JSON line per game to this file")
+    parser.add_argument("--record", default=None,
+                        help="append every game to this game_record file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    specs = [parseAgent(text) for text in args.agents]
+    if len(specs) < 2:
+        print("At least two agents are needed")
+        return 1
+    # the results and the report tell the agents apart by name
+    names = [spec["name"] for spec in specs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        print("Agent names must be unique; add name=... to tell apart: " + ", ".join(duplicates))
+        return 1
+    output = open(args.output, "a") if args.output else None
+    record = game_record.GameWriter(args.record) if args.record else None
+    try:
+        results = runTournament(specs, args.games, args.workers, args.seed, output, record)
+    finally:
+        if output is not None:
+            output.close()
+        if record is not None:
+            record.close()
+    report(specs, results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
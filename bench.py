@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import minimax_vs_uttt
+import negamax
+import uttt_eval
+from uttt_api import *
+
+# define global variables
+# the baseline kept next to this script, wherever it is run from
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+default_threshold = 0.2
+
+def benchPositions(count, randomDepth, seed):
+    # seeded fixed positions from initRandomBoard, as BitboardUtttStates
+    positions = []
+    for i in range(count):
+        random.seed(seed + i)
+        positions.append(BitboardUtttState.from_uttt(minimax_vs_uttt.initRandomBoard(randomDepth)))
+    return positions
+
+def timeLoop(step, seconds):
+    # call step() until seconds have passed; returns (calls, elapsed)
+    calls = 0
+    begin = time.perf_counter()
+    deadline = begin + seconds
+    while True:
+        step()
+        calls += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls, now - begin
+
+def benchSuccessors(state, seconds):
+    return timeLoop(state.successors, seconds)
+
+def benchPlayouts(state, seconds):
+    mc = MonteCarlo(state)
+    return timeLoop(lambda: mc.rollout(state.copy(), 0), seconds)
+
+def benchMonteCarlo(state, seconds):
+    mc = MonteCarlo(state, time=seconds)
+    return mc.search()
+
+def benchMiniMax(state, seconds, searchDepth):
+    minimax_vs_uttt.num_states = 0
+    begin = time.perf_counter()
+    # miniMax prints every goal state it reaches
+    with contextlib.redirect_stdout(io.StringIO()):
+        minimax_vs_uttt.getMove(state, searchDepth=searchDepth, timeout=seconds,
+                                table=TranspositionTable())
+    return minimax_vs_uttt.num_states, time.perf_counter() - begin
+
+def benchNegamax(state, seconds, searchDepth):
+    # same horizon as benchMiniMax
+    search = negamax.NegamaxSearch()
+    begin = time.perf_counter()
+    search.search(state, searchDepth + 1, timeout=seconds)
+    return search.nodes, time.perf_counter() - begin
+
+def benchEvaluator(state, seconds):
+    # positions scored by LinearEvaluator, a batch of the successors per call
+    evaluator = uttt_eval.LinearEvaluator()
+    batch = state.successors()
+    calls, elapsed = timeLoop(lambda: evaluator.evaluate_batch(batch), seconds)
+    return calls * len(batch), elapsed
+
+# what a fresh worker process does before its first search: import the
+# engine, set up the empty position and make a first move
+STARTUP_CODE = (
+    "from uttt_api import UtttState, BitboardUtttState\n"
+    "state = BitboardUtttState()\n"
+    "state.make_move(state.legal_moves()[40])\n"
+    "UtttState().successors()\n"
+)
+
+def benchStartup(seconds):
+    # fresh interpreters importing uttt_api, from this directory whatever
+    # the working directory, and making a first move
+    here = os.path.dirname(os.path.abspath(__file__))
+    return timeLoop(lambda: subprocess.run([sys.executable, "-c", STARTUP_CODE],
+                                           cwd=here, check=True), seconds)
+
+def runBench(positions, seconds, searchDepth):
+    """
+    Measure every benchmark on every position for about `seconds` each;
+    the startup benchmark does not depend on the position and runs once.
+
+    @return: A dictionary with the rate of each benchmark over all positions
+             (total operations / total seconds) and the per-position details.
+    """
+    benches = [
+        ("successors_per_sec", lambda s: benchSuccessors(s, seconds)),
+        ("playouts_per_sec", lambda s: benchPlayouts(s, seconds)),
+        ("mcts_simulations_per_sec", lambda s: benchMonteCarlo(s, seconds)),
+        ("minimax_nodes_per_sec", lambda s: benchMiniMax(s, seconds, searchDepth)),
+        ("negamax_nodes_per_sec", lambda s: benchNegamax(s, seconds, searchDepth)),
+        ("evaluator_positions_per_sec", lambda s: benchEvaluator(s, seconds)),
+    ]
+    metrics = {}
+    details = []
+    for name, bench in benches:
+        total_ops, total_seconds = 0, 0.0
+        for i, state in enumerate(positions):
+            ops, elapsed = bench(state)
+            total_ops += ops
+            total_seconds += elapsed
+            details.append({"metric": name, "position": i, "ops": ops, "seconds": elapsed})
+        metrics[name] = total_ops / total_seconds
+    ops, elapsed = benchStartup(seconds)
+    details.append({"metric": "startups_per_sec", "position": None, "ops": ops, "seconds": elapsed})
+    metrics["startups_per_sec"] = ops / elapsed
+    return {"metrics": metrics, "details": details}
+
+def compareBaseline(metrics, baseline, thresholds):
+    """
+    Compare measured rates against a baseline.
+
+    @param thresholds: The largest allowed relative slowdown per metric name, with
+                       the default under the key None.
+    @return: A list of (metric, measured, baseline, ratio, regressed) tuples.
+    """
+    rows = []
+    for name, base in sorted(baseline.items()):
+        if name not in metrics:
+            continue
+        ratio = metrics[name] / base
+        allowed = thresholds.get(name, thresholds[None])
+        rows.append((name, metrics[name], base, ratio, ratio < 1 - allowed))
+    return rows
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the UTTT state and search engines, and check for regressions.")
+    parser.add_argument("--positions", type=int, default=4,
+                        help="number of seeded positions (default: 4)")
+    parser.add_argument("--random-depth", type=int, default=10,
+                        help="random moves played by initRandomBoard (default: 10)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first position (default: 0)")
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="time spent on every benchmark and position (default: 1)")
+    parser.add_argument("--search-depth", type=int, default=10,
+                        help="searchDepth given to getMove (default: 10)")
+    parser.add_argument("--output", default=None,
+                        help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="baseline JSON to compare against; the run fails if it is "
+                             "missing (default: bench_baseline.json next to bench.py, skipped if missing)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=default_threshold,
+                        help="allowed relative slowdown of every metric (default: %(default)s)")
+    parser.add_argument("--metric-threshold", action="append", default=[],
+                        metavar="METRIC=FRACTION",
+                        help="allowed relative slowdown of one metric; may be repeated")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    thresholds = {None: args.threshold}
+    for item in args.metric_threshold:
+        name, value = item.split("=")
+        thresholds[name] = float(value)
+
+    positions = benchPositions(args.positions, args.random_depth, args.seed)
+    results = runBench(positions, args.seconds, args.search_depth)
+    results["config"] = {
+        "positions": args.positions,
+        "random_depth": args.random_depth,
+        "seed": args.seed,
+        "seconds": args.seconds,
+        "search_depth": args.search_depth,
+    }
+    results["python"] = platform.python_version()
+    results["machine"] = {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+    results["timestamp"] = datetime.datetime.utcnow().isoformat()
+
+    for name, rate in results["metrics"].items():
+        print("{}: {:.1f}".format(name, rate))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baselinePath = args.baseline or default_baseline
+    if args.save_baseline:
+        with open(baselinePath, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline written to " + baselinePath)
+        return 0
+
+    try:
+        with open(baselinePath) as f:
+            baseline = json.load(f)["metrics"]
+    except FileNotFoundError:
+        print("No baseline at " + baselinePath + "; run with --save-baseline to create one")
+        # a baseline asked for by name must be there to compare against
+        return 2 if args.baseline else 0
+
+    regressions = 0
+    for name, rate, base, ratio, regressed in compareBaseline(results["metrics"], baseline, thresholds):
+        print("{}: {:.1f} vs baseline {:.1f} ({:+.1%}){}".format(
+            name, rate, base, ratio - 1, "  REGRESSION" if regressed else ""))
+        regressions += regressed
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
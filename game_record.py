@@ -0,0 +1,189 @@
+import argparse
+import random
+import sys
+import time
+
+from uttt_api import *
+
+# File layout: MAGIC, then one record per game: the number of moves, the
+# result + 1 (0 for a game that did not finish) and one byte per move, the
+# cell 9 * (board - 1) + position - 1. 'O' moves first and the marks
+# alternate, so they are not stored.
+MAGIC = b"UTTTGR01"
+
+def cellOf(action):
+    board, pos, mark = action
+    return 9 * (board - 1) + pos - 1
+
+def actionOf(cell, ply):
+    # the action of the move made at ply (0 for the first move) on cell
+    return (cell // 9 + 1, cell % 9 + 1, ply % 2)
+
+def encodeGame(actions, result = -1):
+    """
+    Return the record of one game.
+
+    @param actions: The actions (board, position, mark) in the order played.
+    @param result: The result of the game (O:0, X:1, DRAW:2) or -1.
+    """
+    cells = bytearray((len(actions), result + 1))
+    for ply, action in enumerate(actions):
+        if action[2] != ply % 2:
+            raise ValueError("move {} is not made by {}".format(ply, "OX"[ply % 2]))
+        cells.append(cellOf(action))
+    return bytes(cells)
+
+def decodeGame(record):
+    """
+    Return (actions, result) from the record of one game.
+    """
+    return [actionOf(cell, ply) for ply, cell in enumerate(record[2:2 + record[0]])], record[1] - 1
+
+class GameWriter(object):
+    '''Appends game records to a file.'''
+
+    def __init__(self, path):
+        """
+        @param path: A file name or a binary file object; MAGIC is written
+                     if the file is empty.
+        """
+        if isinstance(path, str):
+            self.file = open(path, "ab")
+            self.owns_file = True
+        else:
+            self.file = path
+            self.owns_file = False
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.games = 0
+
+    def write(self, actions, result = -1):
+        self.file.write(encodeGame(actions, result))
+        self.games += 1
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class GameReader(object):
+    '''Iterates over the (actions, result) of the games of a file, one game
+    in memory at a time.'''
+
+    def __init__(self, path, buffer_size = 1 << 16):
+        if isinstance(path, str):
+            self.file = open(path, "rb", buffering=buffer_size)
+            self.owns_file = True
+        else:
+            self.file = path
+            self.owns_file = False
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a game record file")
+
+    def __iter__(self):
+        read = self.file.read
+        while True:
+            header = read(2)
+            if not header:
+                return
+            if len(header) != 2:
+                raise ValueError("truncated game record")
+            cells = read(header[0])
+            if len(cells) != header[0]:
+                raise ValueError("truncated game record")
+            yield [actionOf(cell, ply) for ply, cell in enumerate(cells)], header[1] - 1
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def replay(actions, check = True):
+    """
+    Yield the positions of a game, from the empty board to the last move.
+    The same BitboardUtttState is updated in place and yielded after every
+    move, so no earlier position is kept; copy() the ones to keep.
+
+    @param check: Raise ValueError on an illegal move.
+    """
+    state = BitboardUtttState()
+    yield state
+    for action in actions:
+        if check and action not in state.legal_moves():
+            raise ValueError("illegal move {} after {} moves".format(action, len(state.history)))
+        state.make_move(action)
+        yield state
+
+def randomGame(rng):
+    # the actions and result of a game of random moves
+    state = BitboardUtttState()
+    actions = []
+    while not state.is_terminal():
+        action = rng.choice(state.legal_moves())
+        state.make_move(action)
+        actions.append(action)
+    return actions, state.result()
+
+def printGame(actions):
+    # print every position of a game, as StateSpace.print_path does
+    for state in replay(actions):
+        state.print_state()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write, read and replay game record files.")
+    parser.add_argument("path", help="game record file")
+    parser.add_argument("--random", type=int, default=0,
+                        help="first append this many games of random moves")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random games (default: 0)")
+    parser.add_argument("--show", type=int, default=None,
+                        help="print every position of game SHOW (0 for the first)")
+    args = parser.parse_args()
+
+    if args.random:
+        rng = random.Random(args.seed)
+        begin = time.perf_counter()
+        with GameWriter(args.path) as writer:
+            for i in range(args.random):
+                writer.write(*randomGame(rng))
+        print("{} random games written in {:.1f}s".format(
+            args.random, time.perf_counter() - begin))
+
+    if args.show is not None:
+        with GameReader(args.path) as reader:
+            for i, (actions, result) in enumerate(reader):
+                if i == args.show:
+                    printGame(actions)
+                    print("Result:", {O: "O won", X: "X won", DRAW: "Draw", -1: "unfinished"}[result])
+                    break
+        sys.exit(0)
+
+    # stream every game: read, replay and count the results
+    games = moves = 0
+    results = {O: 0, X: 0, DRAW: 0, -1: 0}
+    begin = time.perf_counter()
+    with GameReader(args.path) as reader:
+        for actions, result in reader:
+            games += 1
+            results[result] += 1
+            for state in replay(actions):
+                pass
+            moves += len(actions)
+    elapsed = time.perf_counter() - begin
+    size = len(MAGIC) + 2 * games + moves
+    print("{} games, {} moves, {:.2f} bytes per move".format(games, moves, size / max(moves, 1)))
+    print("O {} X {} draws {} unfinished {}".format(results[O], results[X], results[DRAW], results[-1]))
+    print("read and replayed in {:.2f}s ({:.0f} games/s, {:.0f} moves/s)".format(
+        elapsed, games / elapsed, moves / elapsed))
@@ -1,75 +1,248 @@
-import numpy as np
+import math
 import random
-import datetime
 import time
 from uttt_api import *
 
 # define global variables
 timeout = 10
 num_states = 0
+# nodes searched and beta cutoffs per ply below the root, like num_states
+# counted over every search until reset with resetStats()
+nodes_per_depth = {}
+cutoffs_per_depth = {}
+completed_depth = -1
 states = []
+# shared by successive getMove calls; see transposition_table.stats()
+transposition_table = TranspositionTable()
+
+class SearchTimeout(Exception):
+    '''Raised by miniMax when the deadline of the search has passed.'''
+
+class MoveOrdering(object):
+    '''Move ordering for miniMax: the transposition table move first, then
+    moves that win a small board, moves that block one, the two killer moves
+    of the ply, and the rest by history score.
+    '''
+    # ordering classes, best first
+    TABLE_MOVE = 4
+    SMALL_WIN = 3
+    SMALL_BLOCK = 2
+    KILLER = 1
+
+    def __init__(self):
+        self.killers = {}  # ply: [move, move]
+        self.history = {}  # move: sum of depth**2 over the cutoffs it caused
+
+    def order(self, utttState, moves, tableMove=None):
+        """
+        Return moves sorted best first; ties keep their generation order.
+        """
+        killers = self.killers.get(len(utttState.history), ())
+        history = self.history
+        o, x = utttState.marks
+        mark = moves[0][2] if moves else 0
+        # the board codes with each position marked by the mover and by the
+        # opponent, looked up once per board
+        codes = {}
+        keys = []
+        for move in moves:
+            if move == tableMove:
+                keys.append((self.TABLE_MOVE, 0))
+                continue
+            board, pos = move[0], move[1]
+            code = codes.get(board)
+            if code is None:
+                shift = 9 * (board - 1)
+                code = codes[board] = (o >> shift) & BOARD_MASK | ((x >> shift) & BOARD_MASK) << 9
+            if SMALL_WINNER[code | 1 << (pos - 1 + 9 * mark)] == mark:
+                keys.append((self.SMALL_WIN, 0))
+            elif SMALL_WINNER[code | 1 << (pos + 8 - 9 * mark)] == mark ^ 1:
+                keys.append((self.SMALL_BLOCK, 0))
+            elif move in killers:
+                keys.append((self.KILLER, -killers.index(move)))
+            else:
+                keys.append((0, history.get(move, 0)))
+        order = sorted(range(len(moves)), key=keys.__getitem__, reverse=True)
+        return [moves[i] for i in order]
+
+    def cutoff(self, utttState, move, searchDepth):
+        # record a move that caused a cutoff at utttState
+        ply = len(utttState.history)
+        killers = self.killers.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
+        self.history[move] = self.history.get(move, 0) + searchDepth * searchDepth
+
+def resetStats():
+    global num_states
+    num_states = 0
+    nodes_per_depth.clear()
+    cutoffs_per_depth.clear()
+
+def searchStats():
+    """
+    Return, for every ply below the root, the nodes searched, the beta cutoffs,
+    the cutoff rate and the effective branching factor (nodes at the next ply
+    per node at this one), counted since the last resetStats().
+    """
+    stats = {}
+    for ply in sorted(nodes_per_depth):
+        nodes = nodes_per_depth[ply]
+        cutoffs = cutoffs_per_depth.get(ply, 0)
+        stats[ply] = {"nodes": nodes, "cutoffs": cutoffs,
+                      "cutoff_rate": cutoffs / nodes,
+                      "branching": nodes_per_depth.get(ply + 1, 0) / nodes}
+    return stats
 
 # compute score of current node using minimax
-def miniMax(utttState, searchDepth, alpha, beta):
+# utttState is a BitboardUtttState; moves are made and undone in place
+# deadline is a time.time() value, checked every 1024 nodes
+# ordering is a MoveOrdering; without one only the table move is moved first
+# evaluator is a uttt_eval.Evaluator scoring the leaves instead of the heuristic
+def miniMax(utttState, searchDepth, alpha, beta, table=None, deadline=None, ordering=None,
+            evaluator=None):
     global num_states
     num_states += 1
+    ply = len(utttState.history)
+    nodes_per_depth[ply] = nodes_per_depth.get(ply, 0) + 1
+    if deadline is not None and num_states & 1023 == 0 and time.time() > deadline:
+        raise SearchTimeout()
     # if UTTT has been solved
     if utttState.goal_state() == 0:
         print("Goal state: MAX")
-        return (np.inf, beta)
+        return (math.inf, beta)
     elif utttState.goal_state() == X:
         print("Goal state: MIN")
-        return (alpha, -np.inf)
+        return (alpha, -math.inf)
 
     # apply minimax
-    ChildList = utttState.successors()
     lastPlayer = utttState.action[2]
+    # if minimax has expanded beyond searchDepth
+    if searchDepth == 0:
+        score = utttState.heuristic if evaluator is None else evaluator.evaluate(utttState)
+        if lastPlayer == 0:
+            return (score, beta)
+        return (alpha, score)
+
+    # look the state up in the transposition table: a deep enough entry
+    # may settle the node, otherwise its best move is searched first
+    moves = utttState.legal_moves()
+    alphaOrig, betaOrig = alpha, beta
+    bestMove = None
+    if table is not None:
+        entry = table.probe(utttState.hash)
+        if entry is not None:
+            key, depth, value, bound, bestMove, generation = entry
+            if depth >= searchDepth and (bound == EXACT or
+                                         (bound == LOWER and value >= beta) or
+                                         (bound == UPPER and value <= alpha)):
+                return (value, beta) if lastPlayer == 0 else (alpha, value)
+    if ordering is not None:
+        moves = ordering.order(utttState, moves, bestMove)
+    elif bestMove in moves:
+        moves.remove(bestMove)
+        moves.insert(0, bestMove)
+
     if lastPlayer == 0:
-        # if minimax has expanded beyond searchDepth
-        if searchDepth == 0:
-            return (utttState.heuristic, beta)
-        for x in ChildList:
-            alpha = max(alpha, miniMax(x, searchDepth - 1, alpha, beta)[1])
+        for move in moves:
+            utttState.make_move(move)
+            score = miniMax(utttState, searchDepth - 1, alpha, beta, table, deadline, ordering, evaluator)[1]
+            utttState.undo_move()
+            if score > alpha:
+                alpha = score
+                bestMove = move
             if beta <= alpha:
+                cutoffs_per_depth[ply] = cutoffs_per_depth.get(ply, 0) + 1
+                if ordering is not None:
+                    ordering.cutoff(utttState, move, searchDepth)
                 break
-        return (alpha, beta)
+        value = alpha
+        if alpha >= beta:
+            bound = LOWER
+        elif alpha > alphaOrig:
+            bound = EXACT
+        else:
+            bound = UPPER
     else:
-        # if minimax has expanded beyond searchDepth
-        if searchDepth == 0:
-            return (alpha, utttState.heuristic)
-        for x in ChildList:
-            beta = min(beta, miniMax(x, searchDepth - 1, alpha, beta)[0])
+        for move in moves:
+            utttState.make_move(move)
+            score = miniMax(utttState, searchDepth - 1, alpha, beta, table, deadline, ordering, evaluator)[0]
+            utttState.undo_move()
+            if score < beta:
+                beta = score
+                bestMove = move
             if beta <= alpha:
+                cutoffs_per_depth[ply] = cutoffs_per_depth.get(ply, 0) + 1
+                if ordering is not None:
+                    ordering.cutoff(utttState, move, searchDepth)
                 break
-        return (alpha, beta)
-
-def getMove(utttState, searchDepth=10, timeout=10):
-    nextState = None
-    alphaScore = -np.inf
-    betaScore = np.inf
-    startTime = datetime.datetime.utcnow()
-    for x in utttState.successors():
-        if datetime.datetime.utcnow() - startTime > datetime.timedelta(seconds=timeout):
-            break
-        # print(x.action)
-        if x.currentPlayer==0:
-            alpha = miniMax(x, searchDepth, -np.inf, np.inf)[0]
-            # print("Possible move cost: " + str(alpha))
-            if alphaScore < alpha:
-                nextState = x
-                alphaScore = alpha
+        value = beta
+        if beta <= alpha:
+            bound = UPPER
+        elif beta < betaOrig:
+            bound = EXACT
         else:
-            beta = miniMax(x, searchDepth, -np.inf, np.inf)[1]
-            # print("Possible move cost: " + str(beta))
-            if betaScore > beta:
-                nextState = x
-                betaScore = beta
-    return nextState.action
+            bound = LOWER
+    if table is not None:
+        table.store(utttState.hash, searchDepth, value, bound, bestMove)
+    return (alpha, beta)
+
+# search the root with iterative deepening: depth 0, 1, ..., searchDepth, where
+# depth d looks d+1 moves ahead; each iteration searches the previous best move
+# first and the transposition table feeds the rest of the principal variation
+# back into move ordering. The best move of the deepest fully completed
+# iteration is returned when timeout (seconds) runs out mid-iteration. With an
+# evaluator, pass a table that is not shared with heuristic searches
+def getMove(utttState, searchDepth=10, timeout=10, table=None, evaluator=None):
+    global completed_depth
+    if isinstance(utttState, BitboardUtttState):
+        state = utttState.copy()
+    else:
+        state = BitboardUtttState.from_uttt(utttState)
+    if table is None:
+        table = transposition_table
+    table.new_search()
+    ordering = MoveOrdering()
+    deadline = time.time() + timeout
+    legal = state.legal_moves()
+    if not legal:
+        return None
+    # the player moving now is MAX if it is 'O', as in miniMax
+    maximizing = legal[0][2] == 0
+    order = {move: i for i, move in enumerate(legal)}
+    moves = legal
+    nextMove = legal[0]
+    completed_depth = -1
+    for depth in range(searchDepth + 1):
+        scores = {}
+        bestMove = None
+        try:
+            for move in moves:
+                state.make_move(move)
+                if maximizing:
+                    scores[move] = miniMax(state, depth, -math.inf, math.inf, table, deadline, ordering, evaluator)[0]
+                else:
+                    scores[move] = -miniMax(state, depth, -math.inf, math.inf, table, deadline, ordering, evaluator)[1]
+                state.undo_move()
+                # ties go to the move generated first
+                if bestMove is None or (scores[move], -order[move]) > (scores[bestMove], -order[bestMove]):
+                    bestMove = move
+        except SearchTimeout:
+            # the previous best move is searched first, so a move that beats
+            # it in the unfinished iteration is still an improvement
+            if nextMove in scores and scores[bestMove] > scores[nextMove]:
+                nextMove = bestMove
+            break
+        nextMove = bestMove
+        completed_depth = depth
+        moves = sorted(moves, key=lambda move: (-scores[move], order[move]))
+    return nextMove
 
 def initRandomBoard(randomDepth):
     randomState = UtttState()
     for i in range(randomDepth):
-        randomState = copy.deepcopy(random.choice(randomState.successors()))
+        randomState = random.choice(randomState.successors())
     return randomState
 
 if __name__ == "__main__":
@@ -81,19 +254,23 @@ if __name__ == "__main__":
     print("Possible number of moves: " + str(len(randomS.successors())))
 
     # init game board for two algorithms to compete
-    initState = UtttState()
-    state = copy.deepcopy(initState)
+    state = BitboardUtttState()
+    # the Monte Carlo player keeps its tree between turns
+    MCMethod = MonteCarlo(state, time=10)
     step = 0
-    while state.goal_state() == -1 and state.successors() != []:
+    while not state.is_terminal():
         if step % 2 == 0:
-            MCMethod = MonteCarlo(state, time=10)
-            state = UtttState(parent=state, action=MCMethod.get_play())
+            state = BitboardUtttState(parent=state, action=MCMethod.get_play())
             state.print_state()
             step += 1
         else:
-            state = UtttState(parent=state, action=getMove(state, searchDepth=2, timeout=10))
+            state = BitboardUtttState(parent=state, action=getMove(state, searchDepth=2, timeout=10))
             state.print_state()
             step += 1
+        MCMethod.update(state)
         print("Step: " + str(step))
     state.print_state()
-    print("Winner: " + str(state.goal_state()))
\ No newline at end of file
+    if state.result() == DRAW:
+        print("Draw")
+    else:
+        print("Winner: " + str(state.goal_state()))
@@ -0,0 +1,324 @@
+import argparse
+import contextlib
+import io
+import random
+import sys
+import time
+
+import minimax_vs_uttt
+from minimax_vs_uttt import MoveOrdering, SearchTimeout
+from uttt_api import *
+
+# Scores are from the point of view of the player to move. A won game scores
+# MATE less the number of moves to reach it, so faster wins and slower losses
+# are preferred; heuristic scores stay far below MATE_BOUND.
+MATE = 100000
+MATE_BOUND = MATE - 1000
+INFINITY = MATE + 1
+
+def evaluate(utttState, evaluator = None):
+    # UtttState.heuristic, or the score of a uttt_eval.Evaluator, favours
+    # 'O'; turn it towards the player to move
+    score = utttState.heuristic if evaluator is None else evaluator.evaluate(utttState)
+    if utttState.action[2] == O:
+        return -score
+    return score
+
+def terminalScore(utttState, ply):
+    # score of a finished game for the player to move, ply moves below the root
+    outcome = utttState.result()
+    if outcome == DRAW:
+        return 0
+    if outcome == max(0, utttState.action[2] ^ 1):
+        return MATE - ply
+    return -(MATE - ply)
+
+def toTable(score, ply):
+    # mate scores are stored relative to the node, not the root
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+def fromTable(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+class NegamaxSearch(object):
+    '''Principal variation search in negamax form over a BitboardUtttState.
+
+    One score is returned per node, there is no I/O while searching, and the
+    transposition table, MoveOrdering and deadline work as in miniMax.
+    '''
+
+    def __init__(self, table = None, symmetry = False, stats = None, evaluator = None):
+        """
+        @param table: A TranspositionTable; a new one is used if None.
+        @param symmetry: Key the table on canonical positions, so that the 8
+                         symmetric forms of a position share one entry. Scores
+                         of won and lost games are symmetric, but the
+                         heuristic is not, so its scores are those of
+                         whichever form was searched first.
+        @param stats: A uttt_stats.SearchStats that counts the nodes, and the
+                      successor generation, goal checks and heuristic calls.
+        @param evaluator: A uttt_eval.Evaluator, or its name, scoring the
+                          positions at the horizon in place of the heuristic;
+                          the children of a node one move above the horizon
+                          are scored in one batch.
+        """
+        self.table = table if table is not None else TranspositionTable()
+        self.symmetry = symmetry
+        self.stats = stats
+        self.evaluator = evaluator
+        if isinstance(evaluator, str):
+            import uttt_eval
+            self.evaluator = uttt_eval.get_evaluator(evaluator)
+        self.ordering = MoveOrdering()
+        self.nodes = 0
+        self.deadline = None
+        self.bestMove = None
+
+    def negamax(self, utttState, depth, alpha, beta):
+        """
+        Return the score of utttState searched depth moves deep, for the player
+        to move. utttState is changed in place and restored, unless the deadline
+        passes and SearchTimeout is raised.
+        """
+        self.nodes += 1
+        # checked every 256 nodes, a few milliseconds, so that the short
+        # searches of uttt_server end on time
+        if self.deadline is not None and self.nodes & 255 == 0 and time.time() > self.deadline:
+            raise SearchTimeout()
+        ply = len(utttState.history)
+        if utttState.is_terminal():
+            return terminalScore(utttState, ply)
+        if depth == 0:
+            return evaluate(utttState, self.evaluator)
+        if depth == 1 and ply > 0 and self.evaluator is not None:
+            return self.evaluateChildren(utttState, ply)
+
+        alphaOrig = alpha
+        tableMove = None
+        if self.symmetry:
+            key, frame = utttState.canonical_hash()
+        else:
+            key, frame = utttState.hash, 0
+        entry = self.table.probe(key)
+        if entry is not None:
+            entryKey, entryDepth, value, bound, tableMove, generation = entry
+            value = fromTable(value, ply)
+            if frame and tableMove is not None:
+                tableMove = transform_move(tableMove, SYMMETRY_INVERSE[frame])
+            if entryDepth >= depth and ply > 0:
+                if bound == EXACT:
+                    return value
+                if bound == LOWER:
+                    alpha = max(alpha, value)
+                elif bound == UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        best = -INFINITY
+        bestMove = None
+        moves = self.ordering.order(utttState, utttState.legal_moves(), tableMove)
+        for i, move in enumerate(moves):
+            utttState.make_move(move)
+            if i == 0:
+                score = -self.negamax(utttState, depth - 1, -beta, -alpha)
+            else:
+                # null window first; search again if the move may be better
+                score = -self.negamax(utttState, depth - 1, -alpha - 1, -alpha)
+                if alpha < score < beta:
+                    score = -self.negamax(utttState, depth - 1, -beta, -score)
+            utttState.undo_move()
+            if score > best:
+                best = score
+                bestMove = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                self.ordering.cutoff(utttState, move, depth)
+                break
+
+        if best <= alphaOrig:
+            bound = UPPER
+        elif best >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.table.store(key, depth, toTable(best, ply), bound,
+                         transform_move(bestMove, frame) if frame else bestMove)
+        if ply == 0:
+            self.bestMove = bestMove
+        return best
+
+    def evaluateChildren(self, utttState, ply):
+        # The score of a node one move above the horizon: its children are
+        # scored by the evaluator in one batch, without pruning.
+        best = -INFINITY
+        children = []
+        for move in utttState.legal_moves():
+            child = utttState.copy()
+            child.make_move(move)
+            self.nodes += 1
+            if child.is_terminal():
+                best = max(best, -terminalScore(child, ply + 1))
+            else:
+                children.append(child)
+        if children:
+            scores = self.evaluator.evaluate_batch(children)
+            if utttState.action[2] == O: # 'X' is to move
+                best = max(best, -float(scores.min()))
+            else:
+                best = max(best, float(scores.max()))
+        return best
+
+    def search(self, utttState, depth, timeout = None):
+        """
+        Search with iterative deepening up to depth moves, or until timeout
+        seconds have passed.
+
+        @return: A tuple (score, move, completed depth) of the deepest completed
+                 iteration; move is None if not even depth 1 was completed.
+        """
+        state = utttState.copy()
+        if self.stats is not None:
+            self.stats.instrument_state(state)
+        begin = time.perf_counter()
+        nodes = self.nodes
+        self.table.new_search()
+        self.deadline = time.time() + timeout if timeout is not None else None
+        result = (evaluate(state, self.evaluator), None, 0)
+        try:
+            for d in range(1, depth + 1):
+                score = self.negamax(state, d, -INFINITY, INFINITY)
+                result = (score, self.bestMove, d)
+                if abs(score) >= MATE_BOUND:
+                    break
+        except SearchTimeout:
+            pass
+        finally:
+            self.deadline = None
+        if self.stats is not None:
+            seconds = time.perf_counter() - begin
+            self.stats.add("search", seconds)
+            self.stats.finish(nodes=self.nodes - nodes, depth=result[2], seconds=seconds,
+                              nodes_per_second=(self.nodes - nodes) / seconds,
+                              table=self.table.stats())
+        return result
+
+def negamaxMove(utttState, searchDepth=10, timeout=10, table=None, symmetry=False,
+                evaluator=None):
+    """
+    Drop-in replacement for minimax_vs_uttt.getMove: searches searchDepth + 1
+    moves ahead, the horizon of getMove, and returns the best action.
+    """
+    if not isinstance(utttState, BitboardUtttState):
+        utttState = BitboardUtttState.from_uttt(utttState)
+    legal = utttState.legal_moves()
+    if not legal:
+        return None
+    search = NegamaxSearch(table, symmetry, evaluator=evaluator)
+    score, move, depth = search.search(utttState, searchDepth + 1, timeout)
+    return move if move is not None else legal[0]
+
+def bruteForce(utttState, depth, ply = 0, evaluator = None):
+    """
+    Plain minimax over every move, without pruning, tables or ordering; scored
+    like NegamaxSearch.negamax.
+    """
+    if utttState.is_terminal():
+        return terminalScore(utttState, ply)
+    if depth == 0:
+        return evaluate(utttState, evaluator)
+    best = -INFINITY
+    for move in utttState.legal_moves():
+        utttState.make_move(move)
+        best = max(best, -bruteForce(utttState, depth - 1, ply + 1, evaluator))
+        utttState.undo_move()
+    return best
+
+def randomPosition(seed, plies):
+    # a seeded position after up to plies random moves
+    random.seed(seed)
+    state = BitboardUtttState()
+    for i in range(plies):
+        if state.is_terminal():
+            break
+        state.make_move(random.choice(state.legal_moves()))
+    return state.copy()
+
+def verify(positions=50, depth=3, seed=0, evaluator=None):
+    """
+    Check NegamaxSearch against bruteForce on seeded positions at depths 1 to
+    depth. Returns the list of (seed, depth, negamax score, brute force score)
+    that disagree.
+    """
+    failures = []
+    for i in range(positions):
+        state = randomPosition(seed + i, 20 + i % 40)
+        for d in range(1, depth + 1):
+            expected = bruteForce(state.copy(), d, evaluator=evaluator)
+            score = NegamaxSearch(evaluator=evaluator).negamax(state.copy(), d, -INFINITY, INFINITY)
+            if score != expected:
+                failures.append((seed + i, d, score, expected))
+    return failures
+
+def benchmark(positions=4, searchDepth=4, seed=0):
+    """
+    Nodes per second of NegamaxSearch and of minimax_vs_uttt.getMove over the
+    same seeded positions and horizon.
+
+    @return: A dictionary with the nodes, seconds and nodes/sec of each engine.
+    """
+    results = {}
+    states = [randomPosition(seed + i, 12) for i in range(positions)]
+    nodes, seconds = 0, 0.0
+    for state in states:
+        search = NegamaxSearch()
+        begin = time.perf_counter()
+        search.search(state, searchDepth + 1)
+        seconds += time.perf_counter() - begin
+        nodes += search.nodes
+    results["negamax"] = {"nodes": nodes, "seconds": seconds, "nodes_per_sec": nodes / seconds}
+    minimax_vs_uttt.resetStats()
+    begin = time.perf_counter()
+    # miniMax prints every goal state it reaches
+    with contextlib.redirect_stdout(io.StringIO()):
+        for state in states:
+            minimax_vs_uttt.getMove(state, searchDepth=searchDepth, timeout=10 ** 6,
+                                    table=TranspositionTable())
+    seconds = time.perf_counter() - begin
+    nodes = minimax_vs_uttt.num_states
+    results["minimax"] = {"nodes": nodes, "seconds": seconds, "nodes_per_sec": nodes / seconds}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the negamax engine.")
+    parser.add_argument("--positions", type=int, default=50,
+                        help="seeded positions to check against brute force (default: 50)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="deepest brute force comparison (default: 3)")
+    parser.add_argument("--evaluator", default=None,
+                        help="uttt_eval evaluator to check with (default: the heuristic)")
+    parser.add_argument("--search-depth", type=int, default=4,
+                        help="searchDepth of the nodes/sec benchmark (default: 4)")
+    args = parser.parse_args()
+
+    evaluator = None
+    if args.evaluator is not None:
+        import uttt_eval
+        evaluator = uttt_eval.get_evaluator(args.evaluator)
+    failures = verify(args.positions, args.depth, evaluator=evaluator)
+    for failure in failures:
+        print("Mismatch at seed {} depth {}: negamax {} brute force {}".format(*failure))
+    print("{} positions checked at depths 1 to {}: {} mismatches".format(
+        args.positions, args.depth, len(failures)))
+    for engine, stats in benchmark(searchDepth=args.search_depth).items():
+        print("{}: {nodes} nodes in {seconds:.2f}s, {nodes_per_sec:.0f} nodes/s".format(engine, **stats))
+    sys.exit(1 if failures else 0)
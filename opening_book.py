@@ -0,0 +1,172 @@
+import argparse
+import concurrent.futures
+import mmap
+import random
+import struct
+import sys
+import time
+
+from uttt_api import *
+
+# File layout: a header of MAGIC and the number of records, then the records
+# sorted by key. A record holds the canonical hash of a position (see
+# BitboardUtttState.canonical_hash), the board and position of the book move
+# in that canonical frame, and the plays and wins of that move in the search
+# that chose it.
+MAGIC = b"UTTTBK01"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<QBBII")
+KEY = struct.Struct("<Q")
+
+class OpeningBook(object):
+    '''Read-only opening book, memory-mapped so that every process using the
+    same file shares one copy of it.'''
+
+    def __init__(self, path):
+        """
+        @param path: A book file written by writeBook.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or len(self.data) != HEADER.size + self.size * RECORD.size:
+            self.data.close()
+            raise ValueError(path + " is not an opening book")
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        # process pool workers map the file again
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def find(self, key):
+        """
+        Return the record (key, board, pos, plays, wins) for a canonical hash,
+        or None if the book does not have it.
+        """
+        data = self.data
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(data, HEADER.size + mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size:
+            record = RECORD.unpack_from(data, HEADER.size + lo * RECORD.size)
+            if record[0] == key:
+                return record
+        return None
+
+    def lookup(self, state):
+        """
+        Return (action, plays, wins) of the book move for a BitboardUtttState,
+        or None if the position is not in the book.
+        """
+        key, symmetry = state.canonical_hash()
+        record = self.find(key)
+        if record is None:
+            return None
+        move = transform_move((record[1], record[2], max(0, state.action[2] ^ 1)),
+                              SYMMETRY_INVERSE[symmetry])
+        if move not in state.legal_moves():
+            # a hash collision with a position outside the book
+            return None
+        return move, record[3], record[4]
+
+    def close(self):
+        self.data.close()
+
+def writeBook(path, entries):
+    """
+    Write a book file.
+
+    @param entries: An iterable of (key, board, pos, plays, wins), one per
+                    canonical position; the key must be unique.
+    """
+    entries = sorted(entries)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        for entry in entries:
+            f.write(RECORD.pack(*entry))
+
+def bookPositions(plies):
+    """
+    Return, per ply below the empty board, the canonical positions that can
+    arise in the first `plies` moves, as {canonical hash: state in the
+    canonical frame}. Finished games are left out.
+    """
+    layers = [{BitboardUtttState().canonical_hash()[0]: BitboardUtttState()}]
+    for ply in range(1, plies):
+        layer = {}
+        for state in layers[-1].values():
+            for move in state.legal_moves():
+                child = state.copy()
+                child.make_move(move)
+                if child.is_terminal():
+                    continue
+                key, symmetry = child.canonical_hash()
+                if key not in layer:
+                    layer[key] = child.transform(symmetry)
+        layers.append(layer)
+    return layers
+
+def _bookEntry(key, state, kwargs, seed):
+    # Process pool task: search one canonical position with MonteCarlo and
+    # return its book record, with the move get_play would choose.
+    random.seed(seed)
+    mc = MonteCarlo(state, **kwargs)
+    mc.search()
+    wins, plays, move = max(mc.root_stats(),
+                            key=lambda s: (s[0] / max(s[1], 1), s[2]))
+    return key, move[0], move[1], plays, wins
+
+def buildBook(plies, seconds, workers = None, seed = 0, **kwargs):
+    """
+    Search every canonical position of the first `plies` moves with
+    MonteCarlo for `seconds` each on a process pool.
+
+    @param kwargs: Further MonteCarlo keyword arguments (C, max_moves, ...).
+    @return: The list of book records.
+    """
+    kwargs = dict(kwargs, time=seconds)
+    entries = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = []
+        for layer in bookPositions(plies):
+            for key, state in layer.items():
+                futures.append(executor.submit(_bookEntry, key, state, kwargs, seed))
+                seed += 1
+        for future in concurrent.futures.as_completed(futures):
+            entries.append(future.result())
+    return entries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build an opening book by searching the first moves with MonteCarlo.")
+    parser.add_argument("output", help="book file to write")
+    parser.add_argument("--plies", type=int, default=3,
+                        help="book moves for positions with fewer marks than this (default: 3)")
+    parser.add_argument("--time", type=float, default=10,
+                        help="MonteCarlo time per position in seconds (default: 10)")
+    parser.add_argument("--C", type=float, default=1.4,
+                        help="MonteCarlo exploration constant (default: 1.4)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first search (default: 0)")
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    positions = sum(len(layer) for layer in bookPositions(args.plies))
+    print("{} canonical positions in the first {} plies".format(positions, args.plies))
+    entries = buildBook(args.plies, args.time, args.workers, args.seed, C=args.C)
+    writeBook(args.output, entries)
+    print("{} book moves written to {} in {:.0f}s".format(
+        len(entries), args.output, time.perf_counter() - begin))
+    sys.exit(0)
@@ -0,0 +1,26 @@
+import pytest
+
+import negamax
+import uttt_eval
+
+EVALUATORS = [None, "linear"]
+
+@pytest.mark.parametrize("name", EVALUATORS)
+def test_negamax_matches_brute_force(name):
+    evaluator = uttt_eval.get_evaluator(name) if name is not None else None
+    assert negamax.verify(positions=20, depth=3, evaluator=evaluator) == []
+
+@pytest.mark.parametrize("name", EVALUATORS)
+def test_search_matches_brute_force(name):
+    # search deepens from depth 1, so every iteration starts from the table
+    # the shallower ones left; the same search object also keeps its table
+    # from one depth to the next
+    evaluator = uttt_eval.get_evaluator(name) if name is not None else None
+    for seed in range(10):
+        state = negamax.randomPosition(seed, 20 + 3 * seed)
+        search = negamax.NegamaxSearch(evaluator=evaluator)
+        for depth in range(1, 4):
+            score, move, completed = search.search(state, depth)
+            assert score == negamax.bruteForce(state.copy(), depth, evaluator=evaluator), (seed, depth)
+            if not state.is_terminal():
+                assert move in state.legal_moves()
@@ -1,11 +1,13 @@
-import copy
-import numpy as np
-import uuid
+import array
 import datetime
+import math
 import random
+import sys
+import time
 
 class StateSpace:
     '''Abstract class for defining State spaces for search routines'''
+    __slots__ = ()
     
     def __init__(self, parent, action):
         '''Problem specific state space objects must always include the data items
@@ -48,12 +50,102 @@ class StateSpace:
 O = 0
 X = 1
 EMPTY = -1
+DRAW = 2 # result of a finished game without a winner
 EMPTY_BOARD = {i:EMPTY for i in range(1,10)}
 
+# Bitboard constants
+# Cell (board b, position p) of an ULTIMATE board is bit 9*(b-1) + (p-1) of an
+# 81-bit integer; position p of a single 3x3 board is bit (p-1) of a 9-bit one.
+WIN_LINES = ((1,2,3),(4,5,6),(7,8,9),(1,4,7),(2,5,8),(3,6,9),(1,5,9),(3,5,7))
+LINE_MASKS = tuple(sum(1 << (p-1) for p in line) for line in WIN_LINES)
+BOARD_MASK = 0x1ff
+
+def build_small_tables():
+    """
+    Evaluate every one of the 3^9 configurations of a 3x3 board. The tables
+    are indexed by the board code o9 | x9 << 9, where o9 and x9 are the 9-bit
+    masks of the O and X marks; codes with o9 & x9 != 0 are never used.
+
+    @return: A tuple of tables (winner, heuristic, moves, drawn):
+             winner is the result of TictactoeState.goal_state,
+             heuristic the result of TictactoeState.calcHeuristic,
+             moves the positions a move may be made in, as a tuple of
+             numbers 1 to 9 (empty once won),
+             drawn 1 for a full board without a winner, else 0.
+    """
+    size = 1 << 18
+    winner = array.array('b', [-1]) * size
+    heuristic = array.array('b', [0]) * size
+    moves = [()] * size
+    drawn = array.array('b', [0]) * size
+    positions = [tuple(p + 1 for p in range(9) if mask >> p & 1) for mask in range(512)]
+    count = [bin(mask).count("1") for mask in range(512)]
+    # per 9-bit mask: whether it holds a line, the set of lines (bit i for
+    # WIN_LINES[i]) it has two marks of, and the set of lines it touches
+    wins = [any(mask & line == line for line in LINE_MASKS) for mask in range(512)]
+    pairs = [sum(1 << i for i, line in enumerate(LINE_MASKS) if count[mask & line] == 2)
+             for mask in range(512)]
+    touched = [sum(1 << i for i, line in enumerate(LINE_MASKS) if mask & line)
+               for mask in range(512)]
+    for o9 in range(512):
+        # enumerate every x9 that does not overlap o9
+        free = BOARD_MASK & ~o9
+        o_wins = wins[o9]
+        # calcHeuristic breaks out of its first loop on the first line, so
+        # the "stright line" term only depends on whether 1|2|3 holds an 'O';
+        # then every line of two marks and an empty cell scores one, that is
+        # a line with two marks of one player that the other did not touch
+        base = 1 if o9 & LINE_MASKS[0] else -1
+        o_pairs, o_touched = pairs[o9], touched[o9]
+        x9 = free
+        while True:
+            code = o9 | x9 << 9
+            # O is checked first, as in TictactoeState.goal_state
+            if o_wins:
+                winner[code] = O
+            elif wins[x9]:
+                winner[code] = X
+            heuristic[code] = (base + count[o_pairs & ~touched[x9]]
+                               - count[pairs[x9] & ~o_touched])
+            if winner[code] == -1:
+                empty = free & ~x9
+                moves[code] = positions[empty]
+                drawn[code] = empty == 0
+            if x9 == 0:
+                break
+            x9 = (x9 - 1) & free
+    return winner, heuristic, moves, drawn
+
+# Small board lookup tables, built once at import
+_build_begin = time.perf_counter()
+SMALL_WINNER, SMALL_HEURISTIC, SMALL_MOVES, SMALL_DRAWN = build_small_tables()
+TABLE_BUILD_SECONDS = time.perf_counter() - _build_begin
+
+def small_goal(o9, x9):
+    """
+    Return the winner (O:0 or X:1) of a 3x3 board given as the 9-bit masks of
+    the O and X marks; else, return -1.
+    """
+    return SMALL_WINNER[o9 | x9 << 9]
+
+class FrozenDict(dict):
+    '''Read-only dictionary, for the shared empty position and its boards.
+    copy() and dict() give an ordinary dictionary to change.'''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("a shared " + type(self).__name__ + " is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # copy.deepcopy and pickle would otherwise fill the copy item by item
+        return (FrozenDict, (dict(self),))
+
 class TictactoeState(StateSpace):
     '''Create a 3x3 Tic-Tac-Toe Board State.'''
     
-    def __init__(self, parent = None, action = (0,-1), marks = copy.deepcopy(EMPTY_BOARD)):
+    def __init__(self, parent = None, action = (0,-1), marks = None):
         """
         Create a new Tic-Tac-Toe state.
 
@@ -66,44 +158,30 @@ class TictactoeState(StateSpace):
                        -----
                        7|8|9
         @param marks: A dictionary where the keys are the coordinates of each position, and the value is the type of marks (EMPTY:-1, X:1, or O:0) at the position.
+                      An empty board if None.
         """
         StateSpace.__init__(self, parent, action)
         self.action = action
-        self.marks = marks
+        self.marks = marks if marks is not None else dict(EMPTY_BOARD)
         if parent != None and action != (0,-1):
-            self.marks = copy.deepcopy(parent.marks)
+            self.marks = dict(parent.marks)
             self.marks[action[0]] = action[1]
         self.heuristic = self.calcHeuristic()
 
-    def calcHeuristic(self):
-        # add heuristic score if forms a stright line
-        tripleList = np.array([[1,2,3],[4,5,6],[7,8,9],[1,4,7],[2,5,8],[3,6,9],[1,5,9],[3,5,7]])
-        doubleList = np.array([0,1])
-        marksToList = np.array([self.marks[i] for i in range(1,10)])
-        heuristic = 0
-        for indexList in tripleList:
-            if marksToList[indexList-1].all() == X:
-                heuristic -= 1
-                break
-            elif marksToList[indexList-1].all() == 0:
-                heuristic += 1
-                break
+    def board_code(self):
+        """
+        Return the index o9 | x9 << 9 of this board in the small board lookup tables.
+        """
+        code = 0
+        for pos, mark in self.marks.items():
+            if mark != EMPTY:
+                code |= 1 << (pos - 1 + 9 * mark)
+        return code
 
-        # add heuristic score if forms a stright line of two
-        for indexList in tripleList:
-            if marksToList[indexList-1][0] == X and marksToList[indexList-1][1] == -1 and marksToList[indexList-1][2] == X:
-                heuristic -= 1
-            elif marksToList[indexList-1][0] == -1 and marksToList[indexList-1][1] == X and marksToList[indexList-1][2] == X:
-                heuristic -= 1
-            elif marksToList[indexList-1][0] == X and marksToList[indexList-1][1] == X and marksToList[indexList-1][2] == -1:
-                heuristic -= 1
-            elif marksToList[indexList-1][0] == 0 and marksToList[indexList-1][1] == -1 and marksToList[indexList-1][2] == 0:
-                heuristic += 1
-            elif marksToList[indexList-1][0] == -1 and marksToList[indexList-1][1] == 0 and marksToList[indexList-1][2] == 0:
-                heuristic += 1
-            elif marksToList[indexList-1][0] == 0 and marksToList[indexList-1][1] == 0 and marksToList[indexList-1][2] == -1:
-                heuristic += 1
-        return heuristic
+    def calcHeuristic(self):
+        # add heuristic score if forms a stright line, and for every
+        # stright line of two; see build_small_tables
+        return SMALL_HEURISTIC[self.board_code()]
     
     def successors(self, player):
         """
@@ -130,20 +208,7 @@ class TictactoeState(StateSpace):
         Return the winner (O:0 or X:1) if a player has won this tic-tac-toe board;
         else, return -1.
         """
-        # 8 Winning positions
-        winning = []
-        for i in range(3):
-            winning.append({self.marks[3*i+1], self.marks[3*i+2], self.marks[3*i+3]})
-            winning.append({self.marks[1+i], self.marks[4+i], self.marks[7+i]})
-        winning.append({self.marks[1], self.marks[5], self.marks[9]})
-        winning.append({self.marks[3], self.marks[5], self.marks[7]})
-        
-        if {O} in winning:
-            return O
-        elif {X} in winning:
-            return X
-        else:
-            return -1
+        return SMALL_WINNER[self.board_code()]
 
     def avail_marks(self):
         return [i for i in range(1, 10) if self.marks[i] == -1]
@@ -184,13 +249,18 @@ class TictactoeState(StateSpace):
         print(self.state_string())
 
 # Constants
-EMPTY_UTTT = {i:TictactoeState() for i in range(1,10)}
+# The boards of the empty position, shared by every UtttState built from it:
+# UtttState replaces the TictactoeState of a board when a mark is made and
+# never changes one in place, so the boards are copied by reference. Both
+# the mapping and the marks of its boards are read-only.
+EMPTY_UTTT = FrozenDict(
+    {i:TictactoeState(marks=FrozenDict(EMPTY_BOARD)) for i in range(1,10)})
 
 class UtttState(StateSpace):
     '''Create a 3x3 ULTIMATE Tic-Tac-Toe Board State.'''
     
     def __init__(self, parent = None,
-                 action = (0, 0, -1), boards = copy.deepcopy(EMPTY_UTTT)):
+                 action = (0, 0, -1), boards = None):
         """
         Create a new ULTIMATE Tic-Tac-Toe state.
 
@@ -205,16 +275,17 @@ class UtttState(StateSpace):
                        7|8|9
         @param boards: A dictionary where the keys are the coordinates of each position,
                        and the value is a TictactoeState at the position.
+                       The empty boards if None.
         """
         StateSpace.__init__(self, parent, action)
         self.currentPlayer = action[2]
         self.action = action
         self.parent = parent
-        self.boards = boards
+        self.boards = boards if boards is not None else dict(EMPTY_UTTT)
         self.heuristic = 0
         if parent != None and action != (0, 0, -1):
-            self.boards = copy.deepcopy(parent.boards)
-            stateMark = copy.deepcopy(self.boards.get(action[0]).marks)
+            self.boards = dict(parent.boards)
+            stateMark = dict(self.boards.get(action[0]).marks)
             stateMark[action[1]] = action[2]
             self.boards[action[0]] = TictactoeState(marks = stateMark)
             self.heuristic = parent.heuristic + self.calcHeuristic()
@@ -237,7 +308,7 @@ class UtttState(StateSpace):
         if new_pos != 0 and self.boards[new_pos].goal_state() == -1:
             new_succ = self.boards[new_pos].successors(new_mark)
             for succ in new_succ:
-                new_boards = copy.deepcopy(self.boards)
+                new_boards = dict(self.boards)
                 new_boards[new_pos] = succ
                 new_state = UtttState(parent=self,
                                       action=(new_pos,succ.action[0],new_mark),
@@ -252,7 +323,7 @@ class UtttState(StateSpace):
                 if self.boards[i].goal_state() == -1:
                     new_succ = self.boards[i].successors(new_mark)
                     for succ in new_succ:
-                        new_boards = copy.deepcopy(self.boards)
+                        new_boards = dict(self.boards)
                         new_boards[i] = succ
                         new_state = UtttState(parent=self,
                                               action=(i,succ.action[0],new_mark),
@@ -266,25 +337,37 @@ class UtttState(StateSpace):
         Return the winner (O:0 or X:1) if a player has won this tic-tac-toe board;
         else, return -1.
         """
-        # find status of all tic-tac-toe boards
-        status = {}
+        # find status of all tic-tac-toe boards, as a board code of the
+        # boards won by each player
+        won = [0, 0]
         for i in range(1,10):
-            status[i] = self.boards[i].goal_state()
-            
-        # 8 Winning positions
-        winning = []
-        for i in range(3):
-            winning.append({status[3*i+1], status[3*i+2], status[3*i+3]})
-            winning.append({status[1+i], status[4+i], status[7+i]})
-        winning.append({status[1], status[5], status[9]})
-        winning.append({status[3], status[5], status[7]})
-        
-        if {O} in winning:
-            return O
-        elif {X} in winning:
-            return X
+            status = self.boards[i].goal_state()
+            if status != -1:
+                won[status] |= 1 << (i - 1)
+        return SMALL_WINNER[won[O] | won[X] << 9]
+
+    def result(self):
+        """
+        Return the winner (O:0 or X:1) if the game is won, DRAW if it is over
+        without a winner because there is no legal move left, else -1.
+        """
+        winner = self.goal_state()
+        if winner != -1:
+            return winner
+        # as in successors: the board sent to, if still open, else any open
+        # board; the game goes on while one of them has an empty cell
+        new_pos = self.action[1]
+        if new_pos != 0 and self.boards[new_pos].goal_state() == -1:
+            playable = (new_pos,)
         else:
-            return -1
+            playable = range(1, 10)
+        for i in playable:
+            if self.boards[i].goal_state() == -1 and self.boards[i].avail_marks():
+                return -1
+        return DRAW
+
+    def is_terminal(self):
+        return self.result() != -1
 
     def avail_marks(self):
         return [(i, j) for i in range(1, 10) for j in self.boards[i].avail_marks()]
@@ -332,91 +415,991 @@ class UtttState(StateSpace):
               + " at position " + str(pos))
         print(self.state_string())
 
+# Zobrist keys, drawn from a fixed seed so that hashes agree across processes
+_zobrist_random = random.Random(20180101)
+ZOBRIST_MARKS = tuple(tuple(_zobrist_random.getrandbits(64) for cell in range(81))
+                      for player in (O, X))
+ZOBRIST_FORCED = tuple(_zobrist_random.getrandbits(64) for board in range(10)) # 0: any board
+ZOBRIST_SIDE = _zobrist_random.getrandbits(64) # X to move
+
+def _symmetry(f):
+    # permutation of the positions 1-9 for a map of (row, column)
+    perm = [0] * 10
+    for p in range(1, 10):
+        r, c = f(*divmod(p - 1, 3))
+        perm[p] = 3 * r + c + 1
+    return tuple(perm)
+
+# The 8 symmetries of the square as permutations of the positions 1-9 of a
+# board, with 0 (any board) mapped to itself. A symmetry of the game applies
+# the same permutation to the big board and to every small board.
+SYMMETRIES = tuple(_symmetry(f) for f in (
+    lambda r, c: (r, c),         # identity
+    lambda r, c: (c, 2 - r),     # rotate 90 degrees clockwise
+    lambda r, c: (2 - r, 2 - c), # rotate 180 degrees
+    lambda r, c: (2 - c, r),     # rotate 90 degrees anticlockwise
+    lambda r, c: (r, 2 - c),     # mirror left to right
+    lambda r, c: (2 - r, c),     # mirror top to bottom
+    lambda r, c: (c, r),         # mirror in the main diagonal
+    lambda r, c: (2 - c, 2 - r), # mirror in the other diagonal
+))
+SYMMETRY_INVERSE = tuple(SYMMETRIES.index(tuple(perm.index(p) for p in range(10)))
+                         for perm in SYMMETRIES)
+# transform(a) followed by transform(b) is transform(SYMMETRY_PRODUCT[a][b])
+SYMMETRY_PRODUCT = tuple(tuple(SYMMETRIES.index(tuple(b[a[p]] for p in range(10)))
+                               for b in SYMMETRIES)
+                         for a in SYMMETRIES)
+# bit 9*(b-1)+(p-1) of the marks goes to SYMMETRY_CELLS[s][9*(b-1)+(p-1)]
+SYMMETRY_CELLS = tuple(tuple(9 * (perm[cell // 9 + 1] - 1) + perm[cell % 9 + 1] - 1
+                             for cell in range(81))
+                       for perm in SYMMETRIES)
+# Zobrist key of the image of every cell, per symmetry and player
+ZOBRIST_SYMMETRY = tuple(tuple(tuple(ZOBRIST_MARKS[player][cells[cell]] for cell in range(81))
+                               for player in (O, X))
+                         for cells in SYMMETRY_CELLS)
+
+def build_symmetry_board_keys():
+    # For every player, board and 9-bit mask of that player's marks on the
+    # board, the XOR of the Zobrist keys of the images of those marks under
+    # each of the 8 symmetries: keys[player][512 * (board - 1) + o9][s].
+    keys = []
+    for player in (O, X):
+        table = []
+        for board in range(9):
+            row = [(0,) * 8]
+            for code in range(1, 512):
+                low = code & -code
+                cell = 9 * board + low.bit_length() - 1
+                row.append(tuple(key ^ symmetry[player][cell]
+                                 for key, symmetry in zip(row[code ^ low], ZOBRIST_SYMMETRY)))
+            table.extend(row)
+        keys.append(tuple(table))
+    return tuple(keys)
+
+# built on the first canonical_hash, so that processes searching without
+# symmetry do not pay for it at import
+_symmetry_board_keys = None
+
+def symmetry_board_keys():
+    global _symmetry_board_keys
+    if _symmetry_board_keys is None:
+        _symmetry_board_keys = build_symmetry_board_keys()
+    return _symmetry_board_keys
+
+def transform_move(action, symmetry):
+    """
+    Return the image of an action (board, position, mark) under one of the
+    SYMMETRIES.
+    """
+    board, pos, mark = action
+    perm = SYMMETRIES[symmetry]
+    return (perm[board], perm[pos], mark)
+
+class BitboardUtttState(StateSpace):
+    '''Compact ULTIMATE Tic-Tac-Toe Board State backed by integer bitboards.
+
+    Drop-in replacement for UtttState: successors, goal_state, avail_marks,
+    state_string and heuristic give identical results, but a child is built
+    from a handful of integer operations instead of a deep copy of nine
+    TictactoeState objects.
+    '''
+    __slots__ = ('parent', 'action', 'currentPlayer', 'heuristic_base', 'marks', 'won',
+                 'drawn', 'winner', 'outcome', 'hash', 'history')
+
+    def __init__(self, parent = None, action = (0, 0, -1), marks = None, won = None):
+        """
+        Create a new ULTIMATE Tic-Tac-Toe state.
+
+        @param action: A tuple of (board position, mark position within the board, mark),
+                       encoded as for UtttState.
+        @param marks: A list [O, X] of the 81-bit masks of each player's marks.
+        @param won: A list [O, X] of the 9-bit masks of the boards won by each player.
+        """
+        StateSpace.__init__(self, parent, action)
+        self.currentPlayer = action[2]
+        self.history = []
+        if parent != None and action != (0, 0, -1):
+            self.marks = parent.marks[:]
+            self.won = parent.won[:]
+            self.drawn = parent.drawn
+            self.winner = parent.winner
+            self.heuristic_base = parent.heuristic_base
+            self.hash = parent.hash
+            self.action = parent.action # _apply starts from the parent's action
+            self._apply(action)
+        else:
+            self.marks = marks if marks is not None else [0, 0]
+            if won is None:
+                won = [0, 0]
+                for i in range(1, 10):
+                    winner = small_goal(*self.board_marks(i))
+                    if winner != -1:
+                        won[winner] |= 1 << (i - 1)
+            self.won = won
+            self.drawn = 0
+            for i in range(1, 10):
+                if SMALL_DRAWN[self.board_code(i)]:
+                    self.drawn |= 1 << (i - 1)
+            self.winner = SMALL_WINNER[won[O] | won[X] << 9]
+            self.outcome = self._outcome()
+            self.hash = self.compute_hash()
+            self.heuristic = 0
+
+    def _apply(self, action):
+        # Mark one cell and update the won and drawn boards, the winner and
+        # the result; only the board it belongs to is looked at.
+        board, pos, mark = action
+        shift = 9 * (board - 1)
+        marks = self.marks
+        h = self.hash ^ ZOBRIST_FORCED[self.forced_board()]
+        if self.action[2] == O: # 'X' was to move
+            h ^= ZOBRIST_SIDE
+        old = (marks[O] >> shift) & BOARD_MASK | ((marks[X] >> shift) & BOARD_MASK) << 9
+        new = old | 1 << (pos - 1 + 9 * mark)
+        marks[mark] |= 1 << (shift + pos - 1)
+        if SMALL_WINNER[new] == mark:
+            self.won[mark] |= 1 << (board - 1)
+            self.winner = SMALL_WINNER[self.won[O] | self.won[X] << 9]
+        elif SMALL_DRAWN[new]:
+            self.drawn |= 1 << (board - 1)
+        self.action = action
+        self.currentPlayer = mark
+        self.outcome = self._outcome()
+        h ^= ZOBRIST_MARKS[mark][shift + pos - 1] ^ ZOBRIST_FORCED[self.forced_board()]
+        if mark == O: # 'X' is to move
+            h ^= ZOBRIST_SIDE
+        self.hash = h
+
+    def _outcome(self):
+        # The value of result(), from the winner and the closed boards.
+        if self.winner != -1:
+            return self.winner
+        new_pos = self.forced_board()
+        if new_pos != 0:
+            # a full board that nobody won still forces the next move into it
+            return DRAW if self.drawn >> (new_pos - 1) & 1 else -1
+        if self.won[O] | self.won[X] | self.drawn == BOARD_MASK:
+            return DRAW
+        return -1
+
+    @property
+    def heuristic(self):
+        """
+        The heuristic of UtttState, computed on demand: the sum of
+        calcHeuristic over the nine boards, less that of the state the
+        heuristic was last set on (0 for a new state, as in UtttState).
+        """
+        o, x = self.marks
+        total = self.heuristic_base
+        for shift in range(0, 81, 9):
+            total += SMALL_HEURISTIC[(o >> shift) & BOARD_MASK | ((x >> shift) & BOARD_MASK) << 9]
+        return total
+
+    @heuristic.setter
+    def heuristic(self, value):
+        self.heuristic_base = 0
+        self.heuristic_base = value - self.heuristic
+
+    def compute_hash(self):
+        """
+        Return the 64-bit Zobrist hash of this state, computed from scratch.
+        It covers the marks, the player to move and the board the next move
+        is forced into; make_move keeps self.hash up to date incrementally.
+        """
+        h = ZOBRIST_FORCED[self.forced_board()]
+        if self.action[2] == O: # 'X' is to move
+            h ^= ZOBRIST_SIDE
+        for player in (O, X):
+            bits = self.marks[player]
+            while bits:
+                low = bits & -bits
+                h ^= ZOBRIST_MARKS[player][low.bit_length() - 1]
+                bits ^= low
+        return h
+
+    def canonical_hash(self):
+        """
+        Return (hash, symmetry): the smallest Zobrist hash of the 8 positions
+        symmetric to this state, and the index in SYMMETRIES of the symmetry
+        whose transform(symmetry) has it.
+        """
+        forced = self.forced_board()
+        side = ZOBRIST_SIDE if self.action[2] == O else 0
+        hashes = [ZOBRIST_FORCED[perm[forced]] ^ side for perm in SYMMETRIES]
+        o, x = self.marks
+        keys_o, keys_x = symmetry_board_keys()
+        for board in range(9):
+            o9 = (o >> 9 * board) & BOARD_MASK
+            x9 = (x >> 9 * board) & BOARD_MASK
+            if o9 | x9:
+                hashes = [h ^ ko ^ kx for h, ko, kx in
+                          zip(hashes, keys_o[512 * board + o9], keys_x[512 * board + x9])]
+        h = min(hashes)
+        return h, hashes.index(h)
+
+    def canonical(self):
+        """
+        Return (state, symmetry): the canonical form of this state, i.e. the
+        symmetric position with the smallest hash, and the index in
+        SYMMETRIES of the symmetry that maps this state to it. Moves map the
+        same way with transform_move, and back with SYMMETRY_INVERSE[symmetry].
+        """
+        h, symmetry = self.canonical_hash()
+        return self.transform(symmetry), symmetry
+
+    def transform(self, symmetry):
+        """
+        Return the image of this state under one of the SYMMETRIES, without
+        parent or history. The heuristic, which is not symmetric, is that of
+        a new state.
+        """
+        cells = SYMMETRY_CELLS[symmetry]
+        perm = SYMMETRIES[symmetry]
+        marks = [0, 0]
+        won = [0, 0]
+        for player in (O, X):
+            bits = self.marks[player]
+            while bits:
+                low = bits & -bits
+                marks[player] |= 1 << cells[low.bit_length() - 1]
+                bits ^= low
+            for board in range(1, 10):
+                if self.won[player] >> (board - 1) & 1:
+                    won[player] |= 1 << (perm[board] - 1)
+        return BitboardUtttState(action=transform_move(self.action, symmetry),
+                                 marks=marks, won=won)
+
+    def make_move(self, action):
+        """
+        Apply an action in place. What the action changes besides the mark
+        is pushed onto self.history so undo_move can restore it.
+
+        @param action: A tuple of (board position, mark position within the board, mark),
+                       as returned by legal_moves.
+        """
+        mark = action[2]
+        self.history.append((self.action, self.won[mark], self.drawn,
+                             self.winner, self.outcome, self.hash))
+        self._apply(action)
+
+    def undo_move(self):
+        """
+        Revert the last action applied by make_move.
+        """
+        board, pos, mark = self.action
+        (self.action, self.won[mark], self.drawn,
+         self.winner, self.outcome, self.hash) = self.history.pop()
+        self.marks[mark] &= ~(1 << (9 * (board - 1) + pos - 1))
+        self.currentPlayer = self.action[2]
+
+    def copy(self):
+        """
+        Return a detached copy of this state, without parent or history.
+        """
+        state = BitboardUtttState.__new__(BitboardUtttState)
+        state.parent = None
+        state.action = self.action
+        state.currentPlayer = self.currentPlayer
+        state.heuristic_base = self.heuristic_base
+        state.marks = self.marks[:]
+        state.won = self.won[:]
+        state.drawn = self.drawn
+        state.winner = self.winner
+        state.outcome = self.outcome
+        state.hash = self.hash
+        state.history = []
+        return state
+
+    @classmethod
+    def from_uttt(cls, utttState):
+        """
+        Build the bitboard equivalent of a UtttState. The parent chain is not
+        converted; the heuristic is carried over as is.
+        """
+        marks = [0, 0]
+        for i in range(1, 10):
+            for j in range(1, 10):
+                mark = utttState.boards[i].marks[j]
+                if mark != EMPTY:
+                    marks[mark] |= 1 << (9 * (i - 1) + j - 1)
+        state = cls(action=utttState.action, marks=marks)
+        state.heuristic = utttState.heuristic
+        return state
+
+    def to_uttt(self):
+        """
+        Build the UtttState equivalent of this state. The parent chain is not
+        converted; the heuristic is carried over as is.
+        """
+        boards = {}
+        for i in range(1, 10):
+            o9, x9 = self.board_marks(i)
+            marks = {}
+            for j in range(1, 10):
+                if o9 >> (j - 1) & 1:
+                    marks[j] = O
+                elif x9 >> (j - 1) & 1:
+                    marks[j] = X
+                else:
+                    marks[j] = EMPTY
+            boards[i] = TictactoeState(marks=marks)
+        state = UtttState(action=self.action, boards=boards)
+        state.heuristic = self.heuristic
+        return state
+
+    def board_code(self, board):
+        """
+        Return the index o9 | x9 << 9 of one board in the small board lookup tables.
+        """
+        shift = 9 * (board - 1)
+        return ((self.marks[O] >> shift) & BOARD_MASK |
+                ((self.marks[X] >> shift) & BOARD_MASK) << 9)
+
+    def board_marks(self, board):
+        """
+        Return the 9-bit masks (O, X) of the marks on one board.
+        """
+        shift = 9 * (board - 1)
+        return ((self.marks[O] >> shift) & BOARD_MASK,
+                (self.marks[X] >> shift) & BOARD_MASK)
+
+    def forced_board(self):
+        """
+        Return the board the next move must be played in, or 0 if the next
+        player may choose any board that has not been won.
+        """
+        new_pos = self.action[1]
+        if new_pos != 0 and not (self.won[O] | self.won[X]) >> (new_pos - 1) & 1:
+            return new_pos
+        return 0
+
+    def legal_cells(self):
+        """
+        Return the (board, position) pairs the next player may mark, in the
+        same order as UtttState.successors generates them.
+        """
+        won = self.won[O] | self.won[X]
+        new_pos = self.forced_board()
+        if new_pos != 0:
+            boards = (new_pos,)
+        else:
+            boards = [i for i in range(1, 10) if not won >> (i - 1) & 1]
+        o, x = self.marks
+        cells = []
+        for i in boards:
+            shift = 9 * (i - 1)
+            code = (o >> shift) & BOARD_MASK | ((x >> shift) & BOARD_MASK) << 9
+            cells.extend((i, j) for j in SMALL_MOVES[code])
+        return cells
+
+    def legal_moves(self):
+        """
+        Return the actions that can be performed from this state, without
+        building the states they lead to. If it is the initial state, assume 'O' plays first.
+        """
+        new_mark = max(0, self.action[2] ^ 1) # initial state or opposite player
+        return [(i, j, new_mark) for i, j in self.legal_cells()]
+
+    def successors(self):
+        """
+        Generate all the actions that can be performed from this state, and the states those actions will create. If it is the initial state, assume 'O' plays first.
+        """
+        return [BitboardUtttState(parent=self, action=action)
+                for action in self.legal_moves()]
+
+    def goal_state(self):
+        """
+        Return the winner (O:0 or X:1) if a player has won this tic-tac-toe board;
+        else, return -1.
+        """
+        return self.winner
+
+    def result(self):
+        """
+        Return the winner (O:0 or X:1) if the game is won, DRAW if it is over
+        without a winner because there is no legal move left, else -1.
+        """
+        return self.outcome
+
+    def is_terminal(self):
+        return self.outcome != -1
+
+    def avail_marks(self):
+        occupied = self.marks[O] | self.marks[X]
+        return [(i, j) for i in range(1, 10) for j in range(1, 10)
+                if not occupied >> (9 * (i - 1) + j - 1) & 1]
+
+    def state_string(self):
+        """
+        Return a string representation of a state that can be printed to stdout.
+        """
+        s = []
+        for row in range(3):
+            lines = [[], [], [], [], []]
+            for col in range(3):
+                o9, x9 = self.board_marks(3 * row + col + 1)
+                cells = ["O" if o9 >> p & 1 else "X" if x9 >> p & 1 else " "
+                         for p in range(9)]
+                lines[0].append("|".join(cells[0:3]))
+                lines[1].append("-----")
+                lines[2].append("|".join(cells[3:6]))
+                lines[3].append("-----")
+                lines[4].append("|".join(cells[6:9]))
+            s.extend(" | ".join(line) + "\n" for line in lines)
+            if row != 2:
+                s.append('---------------------\n')
+        return "".join(s)
+
+    def print_state(self):
+        """
+        Print the string representation of the state.
+        """
+        if self.action[2] == -1:
+            act = "None"
+            board = "None"
+            pos = "None"
+        elif self.action[2] == O:
+            act = "'O'"
+            board = self.action[0]
+            pos = self.action[1]
+        else:
+            act = "'X'"
+            board = self.action[0]
+            pos = self.action[1]
+
+        print("ACTION was " + str(act) + " in board " + str(board)
+              + " at position " + str(pos))
+        print(self.state_string())
+
+# Transposition table bound types
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+class TranspositionTable(object):
+    '''Fixed-size hash table of search results keyed by Zobrist hash.
+
+    Each slot holds one entry (key, depth, value, bound, move, generation).
+    A new entry replaces the one in its slot when it has the same key, was
+    searched at least as deep, or the old entry is left over from an
+    earlier search (see new_search).
+    '''
+
+    def __init__(self, size = 1 << 18):
+        """
+        @param size: The number of slots, rounded up to a power of two.
+        """
+        self.size = 1 << max(0, size - 1).bit_length()
+        self.mask = self.size - 1
+        self.entries = [None] * self.size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def new_search(self):
+        # Age every stored entry so that it is the first to be replaced.
+        self.generation += 1
+
+    def clear(self):
+        self.entries = [None] * self.size
+
+    def probe(self, key):
+        """
+        Return the entry (key, depth, value, bound, move, generation) stored
+        for a hash, or None.
+        """
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, bound = EXACT, move = None):
+        """
+        Store a search result for a hash, subject to the replacement policy.
+
+        @param depth: The remaining search depth the value was computed with.
+        @param value: The score, or any payload for callers other than miniMax.
+        @param bound: EXACT, LOWER or UPPER.
+        @param move: The best action found, used first when searching again.
+        """
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is not None and entry[0] != key:
+            if entry[1] > depth and entry[5] == self.generation:
+                return
+            self.evictions += 1
+        self.entries[index] = (key, depth, value, bound, move, self.generation)
+        self.stores += 1
+
+    def stats(self):
+        return {'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'evictions': self.evictions}
+
+class MonteCarloNode(object):
+    '''Node of a Monte Carlo search tree.
+
+    children is parallel to moves, the legal actions of the state the node
+    stands for; an entry stays None until that move has been expanded. In a
+    search keyed on canonical positions, moves are those of the canonical
+    form, and symmetries holds for every child the symmetry that maps the
+    position after the move to the canonical form of the child.
+    '''
+    __slots__ = ('move', 'parent', 'moves', 'children', 'expanded',
+                 'plays', 'wins', 'child_plays', 'symmetries')
+
+    def __init__(self, parent = None, move = None):
+        """
+        @param parent: The node this node was expanded from, or None for the root.
+        @param move: The action leading from parent to this node, or None for the root.
+        """
+        self.move = move
+        self.parent = parent
+        self.moves = None
+        self.children = None
+        self.expanded = 0
+        self.plays = 0
+        self.wins = 0
+        self.child_plays = 0
+        self.symmetries = None
+
+    def init_moves(self, moves, symmetric = False):
+        # Called the first time the search reaches this node.
+        self.moves = moves
+        self.children = [None] * len(moves)
+        if symmetric:
+            self.symmetries = [0] * len(moves)
+
+    def add_child(self, index):
+        child = MonteCarloNode(self, self.moves[index])
+        self.children[index] = child
+        self.expanded += 1
+        return child
+
+    def is_fully_expanded(self):
+        return self.expanded == len(self.moves)
+
+# MonteCarlo keyword arguments kept by the parent of a parallel search and
+# not passed on to the single-process searches it runs
+PARENT_ONLY_KWARGS = ('table', 'executor', 'workers', 'book', 'stats')
+
 class MonteCarlo(object):
     def __init__(self, state, **kwargs):
         # Takes an instance of a Board and optionally some keyword
         # arguments.  Initializes the list of game states and the
-        # statistics tables.
+        # search tree.
+        if not isinstance(state, BitboardUtttState):
+            state = BitboardUtttState.from_uttt(state)
         self.utttState = state
         self.states = [self.utttState]
         seconds = kwargs.get('time', 10)
         self.calculation_time = datetime.timedelta(seconds=seconds)
         self.max_moves = kwargs.get('max_moves', 100)
-        self.wins = {}
-        self.plays = {}
+        self.root = MonteCarloNode()
+        # Positions reached by different move orders share one node when a
+        # TranspositionTable is given. With symmetry = True the nodes are
+        # keyed on canonical positions, so the 8 symmetric forms of a
+        # position share one node too (a table is then always used).
+        self.table = kwargs.get('table')
+        self.symmetry = kwargs.get('symmetry', False)
+        if self.symmetry and self.table is None:
+            self.table = TranspositionTable()
+        self.root_symmetry = self.position_key(state)[1]
         self.C = kwargs.get('C', 1.4)
         self.nodes = 0
+        self.max_depth = 0
+        # With workers > 1 the search runs on a process pool: 'root' plays
+        # one independent tree per worker and merges the root statistics,
+        # 'leaf' farms leaf_rollouts playouts per worker out for every leaf.
+        self.workers = kwargs.get('workers', 1)
+        self.parallel = kwargs.get('parallel', 'root')
+        self.leaf_rollouts = kwargs.get('leaf_rollouts', 8)
+        # The scaling efficiency of a parallel search is measured against
+        # baseline_rate, the simulations per second of one process; give it
+        # or call calibrate() before the first move, else only the pool's
+        # own efficiency is reported.
+        self.baseline_rate = kwargs.get('baseline_rate')
+        self.executor = kwargs.get('executor')
+        self.owns_executor = False
+        self.kwargs = kwargs
+        self.parallel_stats = None
+        self.carried_over = 0
+        # With batch_rollouts = K every leaf is evaluated by K random games
+        # played at once by uttt_rollout.
+        self.batch_rollouts = kwargs.get('batch_rollouts', 0)
+        self.rollouts = 0
+        if self.batch_rollouts:
+            import numpy as np
+            import uttt_rollout
+            self.batch = uttt_rollout
+            self.rng = np.random.default_rng(random.getrandbits(64))
+        # Positions found in the opening book (an opening_book.OpeningBook or
+        # the path of a book file) are played from it without searching.
+        self.book = kwargs.get('book')
+        if isinstance(self.book, str):
+            import opening_book
+            self.book = opening_book.OpeningBook(self.book)
+        # With an evaluator (a uttt_eval.Evaluator or its name) playouts stop
+        # after rollout_depth random moves, and the winner is drawn with the
+        # probability the evaluator gives 'O' in the position reached.
+        self.evaluator = kwargs.get('evaluator')
+        if self.evaluator is not None:
+            import uttt_eval
+            self.evaluator = uttt_eval.get_evaluator(self.evaluator)
+            self.rollout_depth = kwargs.get('rollout_depth', 0)
+            self.rollout = self.cutoff_rollout
+        # With stats = uttt_stats.SearchStats() the phases of every search
+        # are counted and timed; without it nothing is wrapped.
+        self.stats = kwargs.get('stats')
+        if self.stats is not None:
+            self.stats.instrument(self, (('run_simulation', 'simulation'),
+                                         ('select', 'selection'),
+                                         ('expand', 'expansion'),
+                                         ('rollout', 'playout'),
+                                         ('backpropagate', 'backprop')))
 
     def update(self, state):
-        # Takes a game state, and appends it to the history.
+        # Takes a game state, and appends it to the history. If the state
+        # follows from the previous one by a single move, the tree is
+        # advanced along that move, so the next search starts from the
+        # statistics already gathered for that subtree.
+        if not isinstance(state, BitboardUtttState):
+            state = BitboardUtttState.from_uttt(state)
+        previous = self.states[-1].copy()
         self.states.append(state)
+        self.utttState = state
+        follows = False
+        if state.action in previous.legal_moves():
+            previous.make_move(state.action)
+            follows = previous.hash == state.hash
+        if follows:
+            self.advance(state.action)
+        else:
+            self.reset_tree()
+        self.root_symmetry = self.position_key(state)[1]
 
-    def run_simulation(self):
-        # A bit of an optimization here, so we have a local
-        # variable lookup instead of an attribute access each loop.
-        plays, wins = self.plays, self.wins
+    def advance(self, move):
+        # Make the child for move the root. Its siblings and the old root are
+        # no longer referenced and are freed.
+        root = self.root
+        child = None
+        if root.moves is not None:
+            child = root.children[root.moves.index(transform_move(move, self.root_symmetry))]
+        if child is None:
+            self.reset_tree()
+            return
+        child.parent = None
+        child.move = move
+        self.root = child
+        if self.table is not None:
+            # the table would keep the dropped nodes alive
+            self.table.clear()
 
-        visited_states = set()
-        # Plays out a "random" game from the current position,
-        # then updates the statistics tables with the result.
-        states_copy = self.states[:]
-        state = self.states[-1]
+    def reset_tree(self):
+        self.root = MonteCarloNode()
+        if self.table is not None:
+            self.table.clear()
 
-        expand = True
+    def position_key(self, state):
+        # The key of the node for state in the table, and the symmetry that
+        # maps state to the frame the moves of that node are given in.
+        if self.symmetry:
+            return state.canonical_hash()
+        return state.hash, 0
 
-        for t in range(1, self.max_moves + 1):
-            legal = state.successors()
-            moves_states = [state for state in legal]
-            if legal == []:
-                break
-            if all(plays.get((S.action, S.state_string())) for S in moves_states):
+    def init_node(self, node, state, frame):
+        moves = state.legal_moves()
+        if frame:
+            moves = [transform_move(move, frame) for move in moves]
+        node.init_moves(moves, self.symmetry)
+
+    def select(self, state, path):
+        # Descend from the last node of path while every step stays inside
+        # the tree, making the moves on state and appending the nodes to
+        # path. Returns the number of moves made, the index of the move
+        # made from the last node that still has to be expanded (None if the
+        # playout ends at that node) and the table key of the state reached.
+        C = self.C
+        node = path[-1]
+        # the symmetry that maps state to the frame of node
+        frame = self.root_symmetry
+        t = 0
+        while t < self.max_moves and not state.is_terminal():
+            if node.moves is None:
+                self.init_node(node, state, frame)
+            moves, children = node.moves, node.children
+            if node.is_fully_expanded():
                 # If we have stats on all of the legal moves here, use them.
-                log_total = np.log(
-                    sum(plays[(S.action, S.state_string())] for S in moves_states))
-                value, move, state = max(
-                    ((wins[(S.action, S.state_string())] / plays[(S.action, S.state_string())]) +
-                     self.C * np.sqrt(log_total / plays[(S.action, S.state_string())]), S.action, S)
-                    for S in moves_states
-                )
+                log_total = math.log(node.child_plays)
+                index = max(range(len(moves)), key=lambda i: (
+                    children[i].wins / children[i].plays +
+                    C * math.sqrt(log_total / children[i].plays), moves[i]))
             else:
                 # Otherwise, just make an arbitrary decision.
-                state = random.choice(moves_states)
-                move = state.action
-                # print(state.state_string() in [S.state_string() for S in son])
-            states_copy.append(state)
-
-            # `player` here and below refers to the player
-            # who moved into that particular state.
-            if expand and (state.action, state.state_string()) not in plays:
-                self.nodes += 1
-                expand = False
-                plays[(state.action, state.state_string())] = 0
-                wins[(state.action, state.state_string())] = 0
-                if t > self.max_depth:
-                    self.max_depth = t
-
-            visited_states.add((state.action, state.state_string()))
-
-            winner = state.goal_state()
-            if winner != -1:
-                # print("Found goal state")
-                break
+                index = random.randrange(len(moves))
+            move = moves[index]
+            if frame:
+                move = transform_move(move, SYMMETRY_INVERSE[frame])
+            state.make_move(move)
+            t += 1
+            if children[index] is None:
+                key, symmetry = self.position_key(state)
+                if node.symmetries is not None:
+                    node.symmetries[index] = SYMMETRY_PRODUCT[SYMMETRY_INVERSE[frame]][symmetry]
+                if not self.share_node(node, index, key):
+                    return t, index, key
+            if node.symmetries is not None:
+                frame = SYMMETRY_PRODUCT[frame][node.symmetries[index]]
+            node = children[index]
+            path.append(node)
+        return t, None, None
 
-        for player, state in visited_states:
-            if (player, state) not in self.plays:
+    def share_node(self, node, index, key):
+        # Link the child for node.moves[index] to the node already stored for
+        # the same position in the transposition table, if there is one.
+        if self.table is None:
+            return False
+        entry = self.table.probe(key)
+        if entry is None:
+            return False
+        node.children[index] = entry[2]
+        node.expanded += 1
+        return True
+
+    def expand(self, state, path, t, index, key):
+        # Add the child for the move just made from the last node of path.
+        child = path[-1].add_child(index)
+        path.append(child)
+        if self.table is not None:
+            self.table.store(key, 0, child)
+        self.nodes += 1
+        if t > self.max_depth:
+            self.max_depth = t
+
+    def rollout(self, state, t):
+        # Play random moves on state until somebody wins, there is no move
+        # left, or max_moves is reached. Returns the winner or -1.
+        while t < self.max_moves and not state.is_terminal():
+            state.make_move(random.choice(state.legal_moves()))
+            t += 1
+        return state.goal_state()
+
+    def cutoff_rollout(self, state, t):
+        # rollout when an evaluator is given: at most rollout_depth random
+        # moves, then a winner drawn from the evaluator
+        end = min(self.max_moves, t + self.rollout_depth)
+        while t < end and not state.is_terminal():
+            state.make_move(random.choice(state.legal_moves()))
+            t += 1
+        if state.is_terminal() or t >= self.max_moves:
+            return state.goal_state()
+        if random.random() < self.evaluator.win_probability(self.evaluator.evaluate(state)):
+            return O
+        return X
+
+    def backpropagate(self, path, winner, count = 1):
+        # Update the statistics of every node of path with count playouts
+        # won by winner. `player` here refers to the player who moved into
+        # that particular node.
+        path[0].plays += count
+        for parent, node in zip(path, path[1:]):
+            parent.child_plays += count
+            node.plays += count
+            if node.move[2] == winner:
+                node.wins += count
+
+    def run_simulation(self):
+        # Plays out a "random" game from the current position,
+        # then updates the statistics in the tree with the result.
+        # Moves are made in place on a single working copy.
+        state = self.states[-1].copy()
+        if self.stats is not None:
+            self.stats.instrument_state(state)
+        path = [self.root]
+        t, index, key = self.select(state, path)
+        if index is not None:
+            self.expand(state, path, t, index, key)
+        if self.batch_rollouts:
+            winners = self.batch.rollout_state(state, self.batch_rollouts, t,
+                                               self.max_moves, self.rng)
+            for winner, count in self.batch.count_winners(winners).items():
+                if count:
+                    self.backpropagate(path, winner, count)
+            self.rollouts += self.batch_rollouts
+        else:
+            winner = self.rollout(state, t)
+            self.backpropagate(path, winner)
+            self.rollouts += 1
+
+    def search(self):
+        # Run simulations until calculation_time has passed. Returns the
+        # number of simulations and the seconds elapsed.
+        if self.workers > 1 and self.parallel == 'leaf':
+            return self.search_leaf_parallel()
+        games = 0
+        begin = datetime.datetime.utcnow()
+        while datetime.datetime.utcnow() - begin < self.calculation_time:
+            self.run_simulation()
+            games += 1
+        return games, (datetime.datetime.utcnow() - begin).total_seconds()
+
+    def root_plays(self):
+        return self.root.plays
+
+    def root_stats(self):
+        # (wins, plays, move) of every legal move at the root.
+        root = self.root
+        if root.moves is None:
+            self.init_node(root, self.states[-1], self.root_symmetry)
+        inverse = SYMMETRY_INVERSE[self.root_symmetry]
+        return [(child.wins, child.plays, transform_move(move, inverse))
+                if child is not None else (0, 0, transform_move(move, inverse))
+                for move, child in zip(root.moves, root.children)]
+
+    def tree_size(self):
+        # The number of nodes reachable from the root and an estimate of the
+        # bytes they take, counting shared nodes once.
+        seen = set()
+        size = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
                 continue
-            self.plays[(player, state)] += 1
-            if player[2] == winner:
-                self.wins[(player, state)] += 1
+            seen.add(id(node))
+            size += sys.getsizeof(node)
+            if node.moves is not None:
+                size += sys.getsizeof(node.moves) + sys.getsizeof(node.children)
+                size += sum(sys.getsizeof(move) for move in node.moves)
+                if node.symmetries is not None:
+                    size += sys.getsizeof(node.symmetries)
+                stack.extend(child for child in node.children if child is not None)
+        return len(seen), size
+
+    def get_executor(self):
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            self.owns_executor = True
+        return self.executor
+
+    def close(self):
+        # Shut down the process pool, unless it was passed in by the caller.
+        if self.owns_executor:
+            self.executor.shutdown()
+            self.executor = None
+            self.owns_executor = False
+
+    def search_root_parallel(self):
+        # Search one independent tree per worker for calculation_time and
+        # merge their root statistics. Returns the total number of
+        # simulations, the seconds elapsed and the merged root_stats.
+        executor = self.get_executor()
+        kwargs = {key: value for key, value in self.kwargs.items()
+                  if key not in PARENT_ONLY_KWARGS}
+        begin = datetime.datetime.utcnow()
+        futures = [executor.submit(_search_tree, type(self), self.states[-1], kwargs,
+                                   random.getrandbits(64))
+                   for i in range(self.workers)]
+        results = [future.result() for future in futures]
+        elapsed = (datetime.datetime.utcnow() - begin).total_seconds()
+
+        merged = {}
+        for games, seconds, nodes, max_depth, stats in results:
+            self.nodes += nodes
+            self.max_depth = max(self.max_depth, max_depth)
+            for wins, plays, move in stats:
+                total = merged.setdefault(move, [0, 0])
+                total[0] += wins
+                total[1] += plays
+        games = sum(result[0] for result in results)
+        self.rollouts += games * (self.batch_rollouts or 1)
+        self.record_parallel_stats(games, elapsed,
+                                   [(result[0], result[1]) for result in results])
+        return games, elapsed, [(wins, plays, move)
+                                for move, (wins, plays) in merged.items()]
+
+    def search_leaf_parallel(self):
+        # Select and expand leaves in this process and evaluate each one
+        # with leaf_rollouts playouts on every worker.
+        executor = self.get_executor()
+        work = [[0, 0.0] for i in range(self.workers)]
+        games = 0
+        begin = datetime.datetime.utcnow()
+        while datetime.datetime.utcnow() - begin < self.calculation_time:
+            state = self.states[-1].copy()
+            path = [self.root]
+            t, index, key = self.select(state, path)
+            if index is not None:
+                self.expand(state, path, t, index, key)
+            leaf = state.copy()
+            futures = [executor.submit(_leaf_rollouts, leaf, t, self.max_moves,
+                                       self.leaf_rollouts, random.getrandbits(64))
+                       for i in range(self.workers)]
+            for done, future in zip(work, futures):
+                results, seconds = future.result()
+                for winner, count in results.items():
+                    self.backpropagate(path, winner, count)
+                done[0] += self.leaf_rollouts
+                done[1] += seconds
+            games += self.workers * self.leaf_rollouts
+        elapsed = (datetime.datetime.utcnow() - begin).total_seconds()
+        self.record_parallel_stats(games, elapsed, work)
+        return games, elapsed
+
+    def calibrate(self, seconds = 1.0, state = None):
+        """
+        Measure baseline_rate, the simulations per second of a single process,
+        with a serial search of state (default: the current position) for
+        seconds. Call it outside the time of a move; get_play never does.
+
+        @return: The rate.
+        """
+        kwargs = {key: value for key, value in self.kwargs.items()
+                  if key not in PARENT_ONLY_KWARGS}
+        kwargs['time'] = seconds
+        games, elapsed = type(self)(state or self.states[-1], **kwargs).search()
+        self.baseline_rate = games / elapsed if elapsed else 0.0
+        return self.baseline_rate
+
+    def record_parallel_stats(self, games, elapsed, work):
+        # work holds (simulations, seconds busy) per worker. The scaling
+        # efficiency is the simulation rate achieved over workers times the
+        # serial rate (None without a baseline_rate); pool_efficiency, the
+        # rate over the sum of the rates the workers ran at, is what is lost
+        # to the pool itself, so a low efficiency with a high
+        # pool_efficiency means the workers contend for the CPUs.
+        rates = [done / seconds if seconds else 0.0 for done, seconds in work]
+        rate = games / elapsed if elapsed else 0.0
+        serial = self.baseline_rate
+        self.parallel_stats = {
+            'mode': self.parallel,
+            'workers': self.workers,
+            'simulations': games,
+            'seconds': elapsed,
+            'simulations_per_second': rate,
+            'per_worker': rates,
+            'serial_rate': serial,
+            'speedup': rate / serial if serial else None,
+            'efficiency': rate / (self.workers * serial) if serial else None,
+            'pool_efficiency': rate / sum(rates) if sum(rates) else 0.0,
+        }
 
     def get_play(self):
+        if self.book is not None:
+            entry = self.book.lookup(self.utttState)
+            if entry is not None:
+                move, plays, wins = entry
+                print("Book move {} ({} / {})".format(move, wins, plays))
+                return move
         # make next move in the central board if given an empty board
-        if self.utttState.state_string() == UtttState().state_string():
+        if not any(self.utttState.marks):
             return random.choice([(5, i, 0) for i in range(1,10)])
         self.max_depth = 0
-        state = self.states[-1]
-        player = self.utttState.currentPlayer
-        legal = self.utttState.successors()
+        legal = self.utttState.legal_moves()
 
         # Bail out early if there is no real choice to be made.
         if not legal:
@@ -424,31 +1407,56 @@ class MonteCarlo(object):
         if len(legal) == 1:
             return legal[0]
 
-        games = 0
-        begin = datetime.datetime.utcnow()
-        while datetime.datetime.utcnow() - begin < self.calculation_time:
-            self.run_simulation()
-            games += 1
-        moves_states = [state for state in legal]
-        # Display the number of calls of `run_simulation` and the
-        # time elapsed.
-        print(games, self.nodes, datetime.datetime.utcnow() - begin)
+        # simulations kept from earlier moves (see update)
+        self.carried_over = self.root_plays()
+        rss_begin = current_rss() if self.stats is not None else None
+        profiler = self.stats.start_profile() if self.stats is not None else None
+        if self.workers > 1 and self.parallel == 'root':
+            games, elapsed, stats = self.search_root_parallel()
+        else:
+            games, elapsed = self.search()
+            stats = self.root_stats()
+        if self.stats is not None:
+            self.stats.stop_profile(profiler)
+            tree_nodes, tree_bytes = self.tree_size()
+            self.stats.finish(simulations=games, seconds=elapsed,
+                              simulations_per_second=games / elapsed,
+                              rollouts=self.rollouts, carried_over=self.carried_over,
+                              nodes=self.nodes, max_depth=self.max_depth,
+                              tree_nodes=tree_nodes, tree_bytes=tree_bytes,
+                              rss_begin=rss_begin, rss_end=current_rss(),
+                              process_peak_rss=peak_rss())
+        # Display the number of calls of `run_simulation`, the
+        # time elapsed and the simulation rate.
+        print(games, self.nodes, datetime.timedelta(seconds=elapsed),
+              "({:.0f} simulations/s)".format(games / elapsed))
+        if self.carried_over:
+            print("{} simulations carried over from earlier moves".format(self.carried_over))
+        if self.batch_rollouts:
+            print("{} rollouts ({:.0f} rollouts/s)".format(
+                self.rollouts, self.rollouts / elapsed))
+        if self.parallel_stats is not None:
+            if self.parallel_stats['efficiency'] is not None:
+                scaling = ("{speedup:.2f}x speedup over {serial_rate:.0f} serial"
+                           " simulations/s, {efficiency:.0%} scaling efficiency").format(
+                               **self.parallel_stats)
+            else:
+                scaling = "no baseline_rate (see calibrate)"
+            print("{workers} workers ({mode}): {scaling}".format(scaling=scaling,
+                                                                 **self.parallel_stats),
+                  "({:.0%} of the workers' own rate),".format(
+                      self.parallel_stats['pool_efficiency']),
+                  "simulations/s per worker:",
+                  " ".join("{:.0f}".format(rate) for rate in self.parallel_stats['per_worker']))
 
         # Pick the move with the highest percentage of wins.
         percent_wins, move = max(
-            (self.wins.get((S.action, S.state_string()), 0) /
-             self.plays.get((S.action, S.state_string()), 1),
-             S.action)
-            for S in moves_states
-        )
+            (wins / max(plays, 1), move) for wins, plays, move in stats)
 
         # Display the stats for each possible play.
         for x in sorted(
-                ((100 * self.wins.get((S.action, S.state_string()), 0) /
-                      self.plays.get((S.action, S.state_string()), 1),
-                  self.wins.get((S.action, S.state_string()), 0),
-                  self.plays.get((S.action, S.state_string()), 0), S.action)
-                 for S in moves_states),
+                ((100 * wins / max(plays, 1), wins, plays, move)
+                 for wins, plays, move in stats),
                 reverse=True
         ):
             print("{3}: {0:.2f}% ({1} / {2})".format(*x))
@@ -456,3 +1464,264 @@ class MonteCarlo(object):
         print("Maximum depth searched:", self.max_depth)
 
         return move
+
+# Move codes of PooledMonteCarlo: 81 * mark + 9 * (board - 1) + position - 1
+MOVE_CODES = tuple((cell // 9 % 9 + 1, cell % 9 + 1, cell // 81) for cell in range(162))
+
+def encode_move(action):
+    board, pos, mark = action
+    return 81 * mark + 9 * (board - 1) + pos - 1
+
+def peak_rss():
+    # Peak resident set size of this process over its whole life in bytes
+    # (it never drops), or None where the resource module is missing
+    # (Windows).
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss if sys.platform == 'darwin' else rss * 1024
+    # ru_maxrss may lag behind the current size
+    return max(rss, current_rss() or 0)
+
+def current_rss():
+    # Resident set size of this process now in bytes, or None where
+    # /proc/self/statm is missing (macOS, Windows).
+    try:
+        import resource
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (ImportError, OSError, ValueError, IndexError):
+        return None
+
+class PooledMonteCarlo(MonteCarlo):
+    '''MonteCarlo with its tree in a preallocated pool of at most node_budget
+    nodes.
+
+    A node is an index into parallel arrays; the children of a node form a
+    linked list through first_child and next_sibling. When the pool is full,
+    the subtrees whose visits are in the lowest evict_fraction of the tree
+    are freed. Nodes are not shared, so table and symmetry are not supported.
+    '''
+
+    def __init__(self, state, **kwargs):
+        if kwargs.get('table') is not None or kwargs.get('symmetry'):
+            raise ValueError("PooledMonteCarlo does not share nodes; "
+                             "table and symmetry are not supported")
+        self.node_budget = kwargs.get('node_budget', 1 << 18)
+        if self.node_budget < 2:
+            raise ValueError("node_budget must be at least 2")
+        self.evict_fraction = kwargs.get('evict_fraction', 0.5)
+        # allocated once: the tree never takes more than these arrays
+        size = self.node_budget
+        self.plays = array.array('q', bytes(8 * size))
+        self.wins = array.array('q', bytes(8 * size))
+        self.child_plays = array.array('q', bytes(8 * size))
+        self.first_child = array.array('i', bytes(4 * size))
+        self.next_sibling = array.array('i', bytes(4 * size))
+        self.expanded = array.array('B', bytes(size))
+        self.move = array.array('B', bytes(size))
+        self.free = array.array('i')
+        self.used = 0
+        self.evicted = 0
+        MonteCarlo.__init__(self, state, **kwargs)
+        self.reset_tree()
+
+    def allocate(self, parent, code):
+        if self.free:
+            node = self.free.pop()
+        else:
+            node = self.used
+            self.used += 1
+        self.plays[node] = self.wins[node] = self.child_plays[node] = 0
+        self.expanded[node] = 0
+        self.first_child[node] = -1
+        self.move[node] = code
+        if parent != -1:
+            self.next_sibling[node] = self.first_child[parent]
+            self.first_child[parent] = node
+            self.expanded[parent] += 1
+        else:
+            self.next_sibling[node] = -1
+        return node
+
+    def release(self, node):
+        # Return a subtree to the pool.
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.free.append(node)
+            child = self.first_child[node]
+            while child != -1:
+                stack.append(child)
+                child = self.next_sibling[child]
+
+    def in_use(self):
+        return self.used - len(self.free)
+
+    def evict(self):
+        # Free every subtree whose root has no more visits than the nodes in
+        # the lowest evict_fraction of the tree; the root is always kept.
+        plays, first_child, next_sibling = self.plays, self.first_child, self.next_sibling
+        visits = []
+        stack = [self.root]
+        while stack:
+            child = first_child[stack.pop()]
+            while child != -1:
+                visits.append(plays[child])
+                stack.append(child)
+                child = next_sibling[child]
+        if not visits:
+            return
+        visits.sort()
+        threshold = visits[max(0, int(len(visits) * self.evict_fraction) - 1)]
+        before = self.in_use()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            previous = -1
+            child = first_child[node]
+            while child != -1:
+                following = next_sibling[child]
+                if plays[child] <= threshold:
+                    if previous == -1:
+                        first_child[node] = following
+                    else:
+                        next_sibling[previous] = following
+                    self.expanded[node] -= 1
+                    self.child_plays[node] -= plays[child]
+                    self.release(child)
+                else:
+                    stack.append(child)
+                    previous = child
+                child = following
+        self.evicted += before - self.in_use()
+
+    def find_child(self, node, code):
+        child = self.first_child[node]
+        while child != -1 and self.move[child] != code:
+            child = self.next_sibling[child]
+        return child
+
+    def reset_tree(self):
+        self.free = array.array('i')
+        self.used = 0
+        self.root = self.allocate(-1, 0)
+
+    def advance(self, move):
+        # Make the child for move the root and free the rest of the tree.
+        child = self.find_child(self.root, encode_move(move))
+        if child == -1:
+            self.reset_tree()
+            return
+        node = self.first_child[self.root]
+        while node != -1:
+            if node != child:
+                self.release(node)
+            node = self.next_sibling[node]
+        self.free.append(self.root)
+        self.next_sibling[child] = -1
+        self.root = child
+
+    def select(self, state, path):
+        # As MonteCarlo.select, with nodes as pool indices; the move to
+        # expand is returned in place of its index.
+        if not self.free and self.used == self.node_budget:
+            self.evict()
+        C = self.C
+        plays, wins, move_codes = self.plays, self.wins, self.move
+        node = path[-1]
+        t = 0
+        while t < self.max_moves and not state.is_terminal():
+            moves = state.legal_moves()
+            if self.expanded[node] == len(moves):
+                # If we have stats on all of the legal moves here, use them.
+                log_total = math.log(self.child_plays[node])
+                best = None
+                child = self.first_child[node]
+                while child != -1:
+                    value = (wins[child] / plays[child] +
+                             C * math.sqrt(log_total / plays[child]),
+                             MOVE_CODES[move_codes[child]])
+                    if best is None or value > best:
+                        best, node_next = value, child
+                    child = self.next_sibling[child]
+                move = best[1]
+            else:
+                # Otherwise, just make an arbitrary decision.
+                move = random.choice(moves)
+                node_next = self.find_child(node, encode_move(move))
+            state.make_move(move)
+            t += 1
+            if node_next == -1:
+                return t, move, None
+            node = node_next
+            path.append(node)
+        return t, None, None
+
+    def expand(self, state, path, t, move, key):
+        # Add the child for the move just made from the last node of path.
+        path.append(self.allocate(path[-1], encode_move(move)))
+        self.nodes += 1
+        if t > self.max_depth:
+            self.max_depth = t
+
+    def backpropagate(self, path, winner, count = 1):
+        plays, wins, child_plays = self.plays, self.wins, self.child_plays
+        plays[path[0]] += count
+        for parent, node in zip(path, path[1:]):
+            child_plays[parent] += count
+            plays[node] += count
+            if self.move[node] // 81 == winner:
+                wins[node] += count
+
+    def root_plays(self):
+        return self.plays[self.root]
+
+    def root_stats(self):
+        stats = []
+        for move in self.states[-1].legal_moves():
+            child = self.find_child(self.root, encode_move(move))
+            if child == -1:
+                stats.append((0, 0, move))
+            else:
+                stats.append((self.wins[child], self.plays[child], move))
+        return stats
+
+    def tree_size(self):
+        # The nodes in use and the bytes of the pool arrays.
+        size = sum(a.itemsize * len(a) for a in (
+            self.plays, self.wins, self.child_plays, self.first_child,
+            self.next_sibling, self.expanded, self.move, self.free))
+        return self.in_use(), size
+
+    def get_play(self):
+        move = MonteCarlo.get_play(self)
+        rss, peak = current_rss(), peak_rss()
+        print("{} of {} pool nodes in use, {} evicted, RSS {}, process peak RSS {}".format(
+            self.in_use(), self.node_budget, self.evicted,
+            *("{:.0f} MB".format(value / 2 ** 20) if value is not None else "unknown"
+              for value in (rss, peak))))
+        return move
+
+def _search_tree(cls, state, kwargs, seed):
+    # Process pool task for root parallelization: grow one tree from state
+    # with a MonteCarlo of class cls.
+    random.seed(seed)
+    mc = cls(state, **kwargs)
+    games, seconds = mc.search()
+    return games, seconds, mc.nodes, mc.max_depth, mc.root_stats()
+
+def _leaf_rollouts(state, t, max_moves, count, seed):
+    # Process pool task for leaf parallelization: play count random games
+    # from state, t moves below the root. Returns {winner: games} and the
+    # seconds spent.
+    random.seed(seed)
+    begin = datetime.datetime.utcnow()
+    mc = MonteCarlo(state, max_moves=max_moves)
+    results = {}
+    for i in range(count):
+        winner = mc.rollout(state.copy(), t)
+        results[winner] = results.get(winner, 0) + 1
+    return results, (datetime.datetime.utcnow() - begin).total_seconds()
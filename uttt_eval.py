@@ -0,0 +1,149 @@
+import datetime
+import numpy as np
+from uttt_api import O, X, WIN_LINES
+
+# The 8 winning lines as 0-based positions, and the bit shifts of a 64-bit word
+LINES = np.array(WIN_LINES) - 1
+SHIFTS = np.arange(64, dtype=np.uint64)
+LOW_BITS = (1 << 64) - 1
+
+def encode_bits(states):
+    """
+    Convert BitboardUtttStates into boolean arrays without looping over cells.
+
+    @return: A tuple (o, x, won_o, won_x, forced, to_move) where o[i, b, p] and
+             x[i, b, p] tell whether 'O' or 'X' marked position p+1 of board
+             b+1 of state i, won_o[i, b] and won_x[i, b] whether they won that
+             board, forced[i] is the board the next move is forced into (0 for
+             any board) and to_move[i] the next player.
+    """
+    words = np.array([(state.marks[player] & LOW_BITS, state.marks[player] >> 64)
+                      for state in states for player in (O, X)],
+                     dtype=np.uint64).reshape(len(states), 2, 2)
+    bits = ((words[:, :, :, None] >> SHIFTS) & np.uint64(1)).astype(bool)
+    cells = bits.reshape(len(states), 2, 128)[:, :, :81].reshape(len(states), 2, 9, 9)
+    won = np.array([state.won for state in states], dtype=np.int64).reshape(len(states), 2, 1)
+    won = ((won >> np.arange(9)) & 1).astype(bool)
+    forced = np.array([state.forced_board() for state in states], dtype=np.int64)
+    to_move = np.array([max(0, state.action[2] ^ 1) for state in states], dtype=np.int64)
+    return cells[:, O], cells[:, X], won[:, O], won[:, X], forced, to_move
+
+class Evaluator(object):
+    '''Scores positions from the point of view of 'O', as UtttState.heuristic.
+
+    Subclasses implement evaluate_batch; MonteCarlo turns scores into the
+    probability that 'O' wins with win_probability.
+    '''
+    scale = 10.0
+
+    def evaluate(self, state):
+        return self.evaluate_batch([state])[0]
+
+    def evaluate_batch(self, states):
+        """
+        Return a float array with the score of every BitboardUtttState.
+        """
+        raise NotImplementedError
+
+    def win_probability(self, score):
+        # logistic in the score, 0.5 for an even position
+        return 1.0 / (1.0 + np.exp(-score / self.scale))
+
+class HeuristicEvaluator(Evaluator):
+    '''The heuristic of UtttState: the sum of calcHeuristic over the boards.'''
+    scale = 4.0
+
+    def evaluate(self, state):
+        return state.heuristic
+
+    def evaluate_batch(self, states):
+        return np.array([state.heuristic for state in states], dtype=float)
+
+class LinearEvaluator(Evaluator):
+    '''A weighted sum of features, computed for a whole batch at once.
+
+    Every feature counts for 'O' less for 'X':
+    small_two: lines of open boards with two marks of the player, the third empty
+    small_one: lines of open boards with one mark of the player, the others empty
+    big_won: boards won
+    big_two: lines of the big board with two boards won by the player, the third open
+    freedom: the player to move may choose the board
+    '''
+    FEATURES = ('small_two', 'small_one', 'big_won', 'big_two', 'freedom')
+    WEIGHTS = (1.0, 0.25, 4.0, 8.0, 2.0)
+
+    def __init__(self, weights = None):
+        """
+        @param weights: One weight per feature in FEATURES.
+        """
+        self.weights = np.array(self.WEIGHTS if weights is None else weights, dtype=float)
+        if self.weights.shape != (len(self.FEATURES),):
+            raise ValueError("expected {} weights".format(len(self.FEATURES)))
+
+    def features(self, states):
+        """
+        Return the [len(states), len(FEATURES)] array of features.
+        """
+        o, x, won_o, won_x, forced, to_move = encode_bits(states)
+        open_board = ~(won_o | won_x)
+        count_o = o[:, :, LINES].sum(axis=3)
+        count_x = x[:, :, LINES].sum(axis=3)
+        mask = open_board[:, :, None]
+        small_two = (((count_o == 2) & (count_x == 0) & mask).sum(axis=(1, 2)) -
+                     ((count_x == 2) & (count_o == 0) & mask).sum(axis=(1, 2)))
+        small_one = (((count_o == 1) & (count_x == 0) & mask).sum(axis=(1, 2)) -
+                     ((count_x == 1) & (count_o == 0) & mask).sum(axis=(1, 2)))
+        big_won = won_o.sum(axis=1) - won_x.sum(axis=1)
+        # a full board that nobody won is closed too
+        playable = open_board & ~(o | x).all(axis=2)
+        lines_o = won_o[:, LINES].sum(axis=2)
+        lines_x = won_x[:, LINES].sum(axis=2)
+        lines_open = playable[:, LINES].sum(axis=2)
+        big_two = (((lines_o == 2) & (lines_open == 1)).sum(axis=1) -
+                   ((lines_x == 2) & (lines_open == 1)).sum(axis=1))
+        freedom = (forced == 0) * np.where(to_move == O, 1, -1)
+        return np.stack([small_two, small_one, big_won, big_two, freedom], axis=1).astype(float)
+
+    def evaluate_batch(self, states):
+        return self.features(states) @ self.weights
+
+EVALUATORS = {'heuristic': HeuristicEvaluator, 'linear': LinearEvaluator}
+
+def get_evaluator(evaluator):
+    """
+    Return an Evaluator given one, or the name of one in EVALUATORS.
+    """
+    if isinstance(evaluator, str):
+        if evaluator not in EVALUATORS:
+            raise ValueError("Unknown evaluator " + evaluator + "; expected one of "
+                             + ", ".join(EVALUATORS))
+        return EVALUATORS[evaluator]()
+    return evaluator
+
+if __name__ == "__main__":
+    import random
+    from uttt_api import BitboardUtttState
+
+    # positions evaluated per second, for a few batch sizes
+    random.seed(0)
+    positions = []
+    while len(positions) < 4096:
+        state = BitboardUtttState()
+        for i in range(random.randrange(5, 60)):
+            if state.is_terminal():
+                break
+            state.make_move(random.choice(state.legal_moves()))
+        positions.append(state.copy())
+    for name, cls in EVALUATORS.items():
+        evaluator = cls()
+        for size in (1, 64, 1024, 4096):
+            batch = positions[:size]
+            calls = 0
+            begin = datetime.datetime.utcnow()
+            while True:
+                evaluator.evaluate_batch(batch)
+                calls += 1
+                elapsed = (datetime.datetime.utcnow() - begin).total_seconds()
+                if elapsed > 0.5:
+                    break
+            print("{} batch {}: {:.0f} positions/s".format(name, size, calls * size / elapsed))
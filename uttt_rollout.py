@@ -0,0 +1,135 @@
+import datetime
+import numpy as np
+from uttt_api import O, X, EMPTY, WIN_LINES
+
+# The 8 winning lines of TictactoeState.goal_state, as 0-based positions
+LINES = np.array(WIN_LINES) - 1
+BOARDS = np.arange(9)
+
+def encode(states):
+    """
+    Convert BitboardUtttStates into the arrays used by rollout_batch.
+
+    @param states: A sequence of BitboardUtttState.
+    @return: A tuple (cells, won, forced, to_move) where cells[i, b, p] is the mark
+             (EMPTY:-1, O:0 or X:1) at position p+1 of board b+1 of game i,
+             won[i, b] is the winner of board b+1 or -1, forced[i] is the board the
+             next move is forced into (0 for any board) and to_move[i] is the next
+             player.
+    """
+    n = len(states)
+    cells = np.full((n, 9, 9), EMPTY, dtype=np.int8)
+    won = np.full((n, 9), EMPTY, dtype=np.int8)
+    forced = np.zeros(n, dtype=np.int64)
+    to_move = np.zeros(n, dtype=np.int8)
+    for i, state in enumerate(states):
+        for player in (O, X):
+            bits = state.marks[player]
+            while bits:
+                low = bits & -bits
+                cell = low.bit_length() - 1
+                cells[i, cell // 9, cell % 9] = player
+                bits ^= low
+            for board in range(9):
+                if state.won[player] >> board & 1:
+                    won[i, board] = player
+        forced[i] = state.forced_board()
+        to_move[i] = max(0, state.action[2] ^ 1)
+    return cells, won, forced, to_move
+
+def big_goal(won):
+    """
+    Return the winner (O:0 or X:1) of every game given its won boards, else -1;
+    O is checked first, as in UtttState.goal_state.
+    """
+    lines = won[:, LINES]
+    winner = np.full(len(won), EMPTY, dtype=np.int8)
+    winner[(lines == X).all(axis=2).any(axis=1)] = X
+    winner[(lines == O).all(axis=2).any(axis=1)] = O
+    return winner
+
+def rollout_batch(cells, won, forced, to_move, t = 0, max_moves = 100, rng = None):
+    """
+    Play random games on all positions at once, following the rules of
+    BitboardUtttState and the limits of MonteCarlo.rollout. The arrays are
+    updated in place.
+
+    @param cells, won, forced, to_move: Arrays as returned by encode.
+    @param t: The number of moves already made below the search root.
+    @param max_moves: Stop every game once t reaches max_moves.
+    @param rng: A numpy Generator; a fresh one is used if None.
+    @return: An int8 array with the winner (O:0 or X:1) of every game, or -1.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    winner = big_goal(won)
+    active = winner == EMPTY
+    while t < max_moves:
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        # legal cells: empty, on a board that has not been won, and on the
+        # forced board if there is one
+        f = forced[idx]
+        allowed = (won[idx] == EMPTY) & ((f[:, None] == 0) | (BOARDS == f[:, None] - 1))
+        legal = ((cells[idx] == EMPTY) & allowed[:, :, None]).reshape(len(idx), 81)
+        # games without a legal move end without a winner
+        has_move = legal.any(axis=1)
+        active[idx[~has_move]] = False
+        idx = idx[has_move]
+        legal = legal[has_move]
+        if len(idx) == 0:
+            break
+
+        # the largest uniform draw among the legal cells is a uniform choice
+        choice = np.where(legal, rng.random(legal.shape), -1.0).argmax(axis=1)
+        board, pos = np.divmod(choice, 9)
+        player = to_move[idx]
+        cells[idx, board, pos] = player
+
+        # only the board just played can have been won, and only the big
+        # board lines through it can have been completed
+        small = cells[idx, board][:, LINES]
+        line = (small == player[:, None, None]).all(axis=2).any(axis=1)
+        if line.any():
+            won[idx[line], board[line]] = player[line]
+            new = idx[line]
+            big = (won[new][:, LINES] == player[line][:, None, None]).all(axis=2).any(axis=1)
+            winner[new[big]] = player[line][big]
+            active[new[big]] = False
+
+        forced[idx] = np.where(won[idx, pos] == EMPTY, pos + 1, 0)
+        to_move[idx] = player ^ 1
+        t += 1
+    return winner
+
+def rollout_state(state, count, t = 0, max_moves = 100, rng = None):
+    """
+    Play count random games from a single BitboardUtttState.
+
+    @return: An int8 array with the winner of every game, or -1.
+    """
+    cells, won, forced, to_move = encode([state])
+    return rollout_batch(np.repeat(cells, count, axis=0), np.repeat(won, count, axis=0),
+                         np.repeat(forced, count), np.repeat(to_move, count),
+                         t, max_moves, rng)
+
+def count_winners(winners):
+    """
+    Return {winner: games} for an array returned by rollout_batch.
+    """
+    counts = np.bincount(winners.astype(np.int64) + 1, minlength=3)
+    return {EMPTY: int(counts[0]), O: int(counts[1]), X: int(counts[2])}
+
+if __name__ == "__main__":
+    from minimax_vs_uttt import initRandomBoard
+    from uttt_api import BitboardUtttState
+
+    # rollouts per second from a random position, for a few batch sizes
+    state = BitboardUtttState.from_uttt(initRandomBoard(10))
+    for count in (1, 64, 1024, 8192):
+        begin = datetime.datetime.utcnow()
+        winners = rollout_state(state, count)
+        elapsed = (datetime.datetime.utcnow() - begin).total_seconds()
+        print("batch {}: {:.0f} rollouts/s".format(count, count / elapsed),
+              count_winners(winners))
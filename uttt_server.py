@@ -0,0 +1,479 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+
+import negamax
+from arena import parseAgent, percentile
+from uttt_api import *
+from uttt_api import _search_tree
+
+class WorkerLimit(asyncio.Semaphore):
+    '''Semaphore with one permit per executor worker, shared by the agents.
+
+    It also counts the moves being searched, so that under contention each
+    move takes its share of the workers' time instead of waiting for a
+    whole slice.
+    '''
+
+    def __init__(self, workers):
+        asyncio.Semaphore.__init__(self, workers)
+        self.workers = workers
+        self.moves = 0
+
+    def share(self):
+        # the fraction of its time a move may use a worker for
+        return min(1.0, self.workers / max(self.moves, 1))
+
+    @contextlib.contextmanager
+    def searching(self):
+        self.moves += 1
+        try:
+            yield
+        finally:
+            self.moves -= 1
+
+def submitSearch(agent, seconds, function, *args):
+    # Submit function(*args), a search of about `seconds`, to the agent's
+    # executor, holding a permit of agent.limit, and return an asyncio
+    # future of its result. The permit is given back, and agent.overhead
+    # (the seconds a search takes beyond its own) updated, when the search
+    # is done on the executor rather than when the caller stops waiting: a
+    # search given up on still holds its worker.
+    loop = asyncio.get_running_loop()
+    begin = loop.time()
+    try:
+        future = agent.executor.submit(function, *args)
+    except BaseException:
+        if agent.limit is not None:
+            agent.limit.release()
+        raise
+
+    def finished():
+        if agent.limit is not None:
+            agent.limit.release()
+        # up at once on a slow search, down slowly, so that deadlines keep
+        # a margin for the spikes of a loaded machine
+        overhead = max(0.0, loop.time() - begin - seconds)
+        agent.overhead = max(overhead, 0.9 * agent.overhead + 0.1 * overhead)
+
+    def done(future):
+        try:
+            loop.call_soon_threadsafe(finished)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+    future.add_done_callback(done)
+    return asyncio.wrap_future(future)
+
+def quickMove(state):
+    """
+    Return the legal move with the best heuristic for the player to move,
+    one move deep, for when no search came back in time.
+    """
+    best, bestScore = None, None
+    for action in state.legal_moves():
+        state.make_move(action)
+        if state.is_terminal():
+            score = negamax.MATE if state.result() == action[2] else 0
+        else:
+            score = -negamax.evaluate(state)
+        state.undo_move()
+        # ties are broken at random
+        score = (score, random.random())
+        if bestScore is None or score > bestScore:
+            best, bestScore = action, score
+    return best
+
+class AsyncMonteCarloAgent(object):
+    '''MonteCarlo player for asyncio code.
+
+    A search is a series of short MonteCarlo searches (slices) run on an
+    executor, whose root statistics are added up per position; the move is
+    picked from them once the time is up, so the answer is never later than
+    the deadline by more than the executor's latency. While the opponent
+    thinks the agent ponders: it searches the positions after each of the
+    opponent's moves in turn, and keeps the statistics of the one played.
+    When the executor is busy a slice is cut to the time left once it gets
+    a worker, and if none came back the move is picked from the pondered
+    statistics, or by quickMove.
+    '''
+    # shortest slice worth its executor overhead
+    min_slice = 0.01
+
+    def __init__(self, executor, limit = None, time = 1.0, slice = 0.1, ponder = True,
+                 **kwargs):
+        """
+        @param executor: A concurrent.futures executor, shared by the agents.
+        @param limit: A WorkerLimit, shared by the agents, that bounds the
+                      slices on the executor; pondering only uses it when it
+                      is free, so moves come first.
+        @param time: Seconds per move.
+        @param slice: Seconds of one search on the executor.
+        @param ponder: Search during the opponent's turn.
+        @param kwargs: Further MonteCarlo keyword arguments (C, max_moves, ...).
+        """
+        self.executor = executor
+        self.limit = limit
+        self.time = time
+        self.slice = slice
+        self.ponder = ponder
+        self.kwargs = kwargs
+        self.results = {}
+        self.ponder_task = None
+        self.fallbacks = 0
+        # seconds a slice takes on the executor beyond its search time
+        self.overhead = 0.01
+
+    async def search_slice(self, state, seconds, stats, timeout = None, ponder = False):
+        # Run one slice on state and add its root statistics to stats,
+        # {move: [wins, plays]}. Gives up on the slice after timeout seconds;
+        # the slice is shortened to fit in what is left of them once it has
+        # a permit.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        if self.limit is not None:
+            if ponder and self.limit.locked():
+                await asyncio.sleep(self.slice)
+                return
+            try:
+                await asyncio.wait_for(self.limit.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return
+        if deadline is not None:
+            seconds = min(seconds, deadline - loop.time() - self.overhead)
+            if seconds < self.min_slice / 2:
+                if self.limit is not None:
+                    self.limit.release()
+                return
+        future = submitSearch(self, seconds, _search_tree, MonteCarlo, state,
+                              dict(self.kwargs, time=seconds), random.getrandbits(64))
+        try:
+            result = await asyncio.wait_for(
+                future, deadline - loop.time() if deadline is not None else None)
+        except asyncio.TimeoutError:
+            return
+        for wins, plays, move in result[4]:
+            total = stats.setdefault(move, [0, 0])
+            total[0] += wins
+            total[1] += plays
+
+    async def move(self, state, seconds = None):
+        """
+        Return the action to play in a BitboardUtttState within seconds
+        (default: self.time), or None if there is no legal move.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.time if seconds is None else seconds)
+        await self.stop_ponder()
+        legal = state.legal_moves()
+        if len(legal) <= 1:
+            return legal[0] if legal else None
+        # statistics pondered for this position, if any
+        stats = self.results.get(state.hash, {})
+        self.results = {}
+        with self.limit.searching() if self.limit is not None else contextlib.nullcontext():
+            while True:
+                remaining = deadline - loop.time()
+                if remaining - self.overhead < self.min_slice:
+                    break
+                seconds = self.slice
+                if self.limit is not None:
+                    seconds = max(seconds * self.limit.share(), self.min_slice)
+                await self.search_slice(state, min(seconds, remaining), stats, remaining)
+        if not stats:
+            # no slice came back in time, nor was this position pondered
+            self.fallbacks += 1
+            return quickMove(state)
+        # Pick the move with the highest percentage of wins, as get_play.
+        return max((wins / max(plays, 1), move) for move, (wins, plays) in stats.items())[1]
+
+    def start_ponder(self, state):
+        """
+        Search the replies to the opponent's possible moves from state until
+        stop_ponder or move is called.
+        """
+        if self.ponder and not state.is_terminal():
+            self.ponder_task = asyncio.ensure_future(self.run_ponder(state))
+
+    async def run_ponder(self, state):
+        children = []
+        for action in state.legal_moves():
+            child = state.copy()
+            child.make_move(action)
+            if not child.is_terminal():
+                children.append(child)
+        self.results = {child.hash: {} for child in children}
+        while children:
+            for child in children:
+                await self.search_slice(child, self.slice, self.results[child.hash],
+                                        ponder=True)
+
+    async def stop_ponder(self):
+        """
+        Cancel pondering; a slice already running on the executor finishes
+        there but its result is dropped.
+        """
+        task, self.ponder_task = self.ponder_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+class AsyncNegamaxAgent(object):
+    '''negamaxMove player for asyncio code; it does not ponder.'''
+
+    def __init__(self, executor, limit = None, time = 1.0, searchDepth = 10,
+                 symmetry = False):
+        self.executor = executor
+        self.limit = limit
+        self.time = time
+        self.searchDepth = searchDepth
+        self.symmetry = symmetry
+        self.fallbacks = 0
+        # seconds a search takes on the executor beyond its timeout
+        self.overhead = 0.02
+
+    async def move(self, state, seconds = None):
+        seconds = self.time if seconds is None else seconds
+        legal = state.legal_moves()
+        if len(legal) <= 1:
+            return legal[0] if legal else None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + seconds
+        # the move counts towards the workers' share until its search is
+        # back, not only while it waits for a permit
+        try:
+            with self.limit.searching() if self.limit is not None else contextlib.nullcontext():
+                share = 1.0
+                if self.limit is not None:
+                    await asyncio.wait_for(self.limit.acquire(), seconds)
+                    share = self.limit.share()
+                # search for this move's share of the workers' time, at least
+                # 5 ms, within what is left once there is a permit, less the
+                # executor's overhead
+                timeout = min(deadline - loop.time() - self.overhead, max(share * seconds, 0.005))
+                if timeout < 0.002:
+                    if self.limit is not None:
+                        self.limit.release()
+                    raise asyncio.TimeoutError()
+                future = submitSearch(self, timeout, negamax.negamaxMove, state,
+                                      self.searchDepth, timeout, None, self.symmetry)
+                return await asyncio.wait_for(future, deadline - loop.time())
+        except asyncio.TimeoutError:
+            self.fallbacks += 1
+            return quickMove(state)
+
+    def start_ponder(self, state):
+        pass
+
+    async def stop_ponder(self):
+        pass
+
+ASYNC_AGENTS = {'mcts': AsyncMonteCarloAgent, 'negamax': AsyncNegamaxAgent}
+
+class Metrics(object):
+    '''Games, moves and latencies seen by the server or the clients.'''
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+        self.games = 0
+        self.moves = 0
+        self.fallbacks = 0
+        self.latencies = []
+
+    def report(self, name):
+        elapsed = time.perf_counter() - self.begin
+        summary = {"games": self.games, "moves": self.moves, "seconds": elapsed,
+                   "games_per_sec": self.games / elapsed,
+                   "moves_per_sec": self.moves / elapsed,
+                   "fallbacks": self.fallbacks}
+        if self.latencies:
+            summary.update({"p50_ms": 1000 * percentile(self.latencies, 0.5),
+                            "p90_ms": 1000 * percentile(self.latencies, 0.9),
+                            "p99_ms": 1000 * percentile(self.latencies, 0.99),
+                            "max_ms": 1000 * max(self.latencies)})
+        print(name + ": " + json.dumps(summary))
+        return summary
+
+async def send(writer, message):
+    writer.write((json.dumps(message) + "\n").encode())
+    await writer.drain()
+
+async def serveGame(reader, writer, makeAgent, metrics):
+    """
+    Play one game per connection. The client sends one JSON line per turn:
+    its action [board, position, mark], or, as its first line only, null to
+    let the server move first.
+    The server answers {"move": [board, position, mark] or null,
+    "result": -1 while playing, else the winner O:0, X:1 or DRAW:2}, or
+    {"error": ...} if the line is not a legal action.
+    """
+    agent = makeAgent()
+    state = BitboardUtttState()
+    try:
+        while not state.is_terminal():
+            line = await reader.readline()
+            if not line:
+                break
+            await agent.stop_ponder()
+            try:
+                request = json.loads(line)
+                if request is None:
+                    if state.history:
+                        raise ValueError("null is only accepted before the first move")
+                else:
+                    request = tuple(request)
+                    legal = state.legal_moves()
+                    if request not in legal:
+                        raise ValueError("illegal action")
+                    # the legal action itself: [5.0, 5.0, 0.0] is equal to
+                    # (5, 5, 0) but cannot be played as it is
+                    request = legal[legal.index(request)]
+            except (ValueError, TypeError) as error:
+                await send(writer, {"error": str(error), "legal": state.legal_moves()})
+                continue
+            if request is not None:
+                state.make_move(request)
+                if state.is_terminal():
+                    await send(writer, {"move": None, "result": state.result()})
+                    break
+            begin = time.perf_counter()
+            action = await agent.move(state)
+            metrics.latencies.append(time.perf_counter() - begin)
+            metrics.moves += 1
+            state.make_move(action)
+            await send(writer, {"move": list(action), "result": state.result()})
+            agent.start_ponder(state)
+        if state.is_terminal():
+            metrics.games += 1
+    finally:
+        await agent.stop_ponder()
+        metrics.fallbacks += agent.fallbacks
+        writer.close()
+
+async def playClient(host, port, seed, metrics):
+    # Play one game of random moves against the server; the server moves
+    # first, as 'O', in odd games. Returns the result and the server's mark.
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    state = BitboardUtttState()
+    request = None if seed % 2 else rng.choice(state.legal_moves())
+    server = O if request is None else X
+    try:
+        while True:
+            if request is not None:
+                state.make_move(request)
+            begin = time.perf_counter()
+            await send(writer, request)
+            reply = json.loads(await reader.readline())
+            metrics.latencies.append(time.perf_counter() - begin)
+            if "error" in reply:
+                raise RuntimeError(reply["error"])
+            metrics.moves += 1
+            if reply["move"] is not None:
+                state.make_move(tuple(reply["move"]))
+            if reply["result"] != -1:
+                metrics.games += 1
+                return reply["result"], server
+            request = rng.choice(state.legal_moves())
+    finally:
+        writer.close()
+
+async def runClients(host, port, games, concurrency, seed):
+    metrics = Metrics()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def play(gameSeed):
+        async with limit:
+            return await playClient(host, port, gameSeed, metrics)
+
+    results = await asyncio.gather(*(play(seed + i) for i in range(games)))
+    return metrics, results
+
+def agentFactory(spec, executor, workers):
+    spec = parseAgent(spec)
+    if spec["type"] not in ASYNC_AGENTS:
+        raise ValueError("No async agent for " + spec["type"] + "; expected one of "
+                         + ", ".join(ASYNC_AGENTS))
+    cls = ASYNC_AGENTS[spec["type"]]
+    limit = WorkerLimit(workers or os.cpu_count() or 1)
+    return lambda: cls(executor, limit, **spec["kwargs"])
+
+async def serve(args, executor):
+    metrics = Metrics()
+    makeAgent = agentFactory(args.agent, executor, args.workers)
+    server = await asyncio.start_server(
+        lambda reader, writer: serveGame(reader, writer, makeAgent, metrics),
+        args.host, args.port, backlog=1024)
+    print("Serving on {}:{}".format(args.host, server.sockets[0].getsockname()[1]))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        metrics.report("server")
+
+async def bench(args, executor):
+    # Play args.games client games against a server: the one at args.port,
+    # or one started here on a free port.
+    server = None
+    port = args.port
+    if not port:
+        metrics = Metrics()
+        makeAgent = agentFactory(args.agent, executor, args.workers)
+        server = await asyncio.start_server(
+            lambda reader, writer: serveGame(reader, writer, makeAgent, metrics),
+            args.host, 0, backlog=1024)
+        port = server.sockets[0].getsockname()[1]
+    clients, results = await runClients(args.host, port, args.games, args.concurrency, args.seed)
+    clients.report("clients")
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+        metrics.report("server")
+    # the server plays 'O' and 'X' in turn, so count its results
+    wins = sum(result == server for result, server in results)
+    draws = sum(result == DRAW for result, server in results)
+    losses = sum(result == server ^ 1 for result, server in results)
+    print("server results: {} wins {} draws {} losses".format(wins, draws, losses))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Serve UTTT games over TCP, one game per connection and one JSON "
+                    "action [board, position, mark] per line, or load test a server.")
+    parser.add_argument("command", choices=("serve", "bench"),
+                        help="serve games, or play random clients against a server")
+    parser.add_argument("--agent", default="mcts:time=0.5",
+                        help="server agent spec, mcts:... or negamax:... (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0,
+                        help="port to serve on or to load test; bench starts its own "
+                             "server if not given")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="search processes (default: one per CPU)")
+    parser.add_argument("--games", type=int, default=200,
+                        help="client games played by bench (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="client games played at once by bench (default: 200)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first client game (default: 0)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        try:
+            asyncio.run((serve if args.command == "serve" else bench)(args, executor))
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
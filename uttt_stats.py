@@ -0,0 +1,150 @@
+import cProfile
+import json
+import pstats
+import time
+
+from uttt_api import BitboardUtttState
+
+class SearchStats(object):
+    '''Counters and timers of a search engine.
+
+    Pass an instance as stats= to MonteCarlo or NegamaxSearch. Engines only
+    wrap their phases and working states when they are given one, so a search
+    without stats runs exactly the code it ran before. Calls and seconds add
+    up over searches; values (tree size, depth, ...) are those of the last
+    search.
+    '''
+
+    def __init__(self, callback = None, profile = False):
+        """
+        @param callback: Called with this object at the end of every search.
+        @param profile: Run every MonteCarlo.get_play search under cProfile and
+                        keep the time spent per function in self.profile_stats.
+        """
+        self.callback = callback
+        self.profile = profile
+        self.state_class = instrumented_state_class(self)
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.seconds = {}
+        self.values = {}
+        self.profile_stats = None
+
+    def add(self, name, seconds, calls = 1):
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def timed(self, name, function):
+        """
+        Return function wrapped so that every call is counted and timed under name.
+        """
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - begin)
+        return wrapper
+
+    def instrument(self, obj, phases):
+        """
+        Replace methods of obj by timed wrappers.
+
+        @param phases: Pairs of (method name, phase name).
+        """
+        for method, name in phases:
+            setattr(obj, method, self.timed(name, getattr(obj, method)))
+
+    def instrument_state(self, state):
+        # count the successor generation, goal checks and heuristic of a
+        # working state; the state must not be shared with the caller
+        state.__class__ = self.state_class
+        return state
+
+    def start_profile(self):
+        # an enabled profiler in profile mode, else None
+        if not self.profile:
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profile(self, profiler, limit = 30):
+        # keep the calls, own time and cumulative time of the functions
+        # with the most cumulative time
+        if profiler is None:
+            return
+        profiler.disable()
+        entries = []
+        for (filename, line, function), (primitive, calls, own, total, callers) in \
+                pstats.Stats(profiler).stats.items():
+            entries.append({"function": "{}:{}({})".format(filename, line, function),
+                            "calls": calls, "own_seconds": own, "seconds": total})
+        entries.sort(key=lambda entry: entry["seconds"], reverse=True)
+        self.profile_stats = entries[:limit]
+
+    def finish(self, **values):
+        # record the values of a finished search and call the callback
+        self.values.update(values)
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        return {"calls": dict(self.calls), "seconds": dict(self.seconds),
+                "values": dict(self.values), "profile": self.profile_stats}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+def instrumented_state_class(stats):
+    """
+    Return a subclass of BitboardUtttState that counts and times successor
+    generation, goal checks and the heuristic into stats.
+    """
+    base = BitboardUtttState
+    clock = time.perf_counter
+
+    def get_heuristic(self):
+        begin = clock()
+        value = base.heuristic.fget(self)
+        stats.add("heuristic", clock() - begin)
+        return value
+
+    class InstrumentedUtttState(base):
+        __slots__ = ()
+
+        def legal_moves(self):
+            begin = clock()
+            moves = base.legal_moves(self)
+            stats.add("successors", clock() - begin)
+            return moves
+
+        def successors(self):
+            begin = clock()
+            states = base.successors(self)
+            stats.add("successors", clock() - begin)
+            return states
+
+        def is_terminal(self):
+            begin = clock()
+            terminal = base.is_terminal(self)
+            stats.add("goal_checks", clock() - begin)
+            return terminal
+
+        def result(self):
+            begin = clock()
+            outcome = base.result(self)
+            stats.add("goal_checks", clock() - begin)
+            return outcome
+
+        def goal_state(self):
+            begin = clock()
+            winner = base.goal_state(self)
+            stats.add("goal_checks", clock() - begin)
+            return winner
+
+        heuristic = property(get_heuristic, base.heuristic.fset)
+
+    return InstrumentedUtttState